@@ -1,31 +1,78 @@
 # app.py - Updated Flask application with authentication and database persistence
-from flask import Flask, render_template, request, jsonify, send_file, flash, redirect, url_for
+from flask import Flask, Request, current_app, render_template, request, jsonify, send_file, flash, redirect, url_for, has_request_context
+from flask.json.provider import JSONProvider
 from flask_login import LoginManager, login_required, current_user
+from flask_session import Session
 import pandas as pd
 import numpy as np
 from datetime import datetime, timedelta
 import os
 import uuid
+from werkzeug.exceptions import HTTPException, InternalServerError
 from werkzeug.utils import secure_filename
 import io
-import base64
 import hashlib
+import mmap
+import shutil
+import tempfile
+import threading
+import orjson
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from sqlalchemy import text
 
 # Import our models and authentication
 from models import db, init_database, User, ProcessingJob, PatientResult, ProcessingAudit
-from auth import auth_bp
+from auth import auth_bp, cache, limiter, load_user_cached
+from audit import AuditWriter
 from utils.data_processor import DataProcessor
 from utils.icaht_grader import ICahtGrader
 from utils.excel_handler import ExcelHandler
-from config import Config
+from config import Config, config_by_name
 
-def create_app():
+try:
+    from redis import Redis
+    from rq import Queue
+except ImportError:  # rq not installed - process jobs inside the request
+    Queue = None
+
+class UploadRequest(Request):
+    """Request that spools file uploads to the upload folder past a small memory buffer"""
+    
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.SpooledTemporaryFile(
+            max_size=current_app.config['UPLOAD_BUFFER_SIZE'],
+            dir=current_app.config['UPLOAD_FOLDER']
+        )
+
+class ORJSONProvider(JSONProvider):
+    """JSON provider backed by orjson, which encodes datetimes and numpy values natively"""
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=str, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+# Audit rows are written in batches off the request path
+audit_writer = AuditWriter()
+
+def create_app(config_class=Config):
     """Application factory pattern"""
     app = Flask(__name__)
-    app.config.from_object(Config)
+    app.config.from_object(config_class)
+    app.json = ORJSONProvider(app)
+    app.request_class = UploadRequest
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
     
     # Initialize extensions
     db.init_app(app)
+    cache.init_app(app)
+    limiter.init_app(app)
+    audit_writer.init_app(app)
+    if app.config['SESSION_TYPE'] == 'redis':
+        app.config['SESSION_REDIS'] = Redis.from_url(app.config['REDIS_URL'])
+        Session(app)
     
     # Initialize Flask-Login
     login_manager = LoginManager()
@@ -36,7 +83,8 @@ def create_app():
     
     @login_manager.user_loader
     def load_user(user_id):
-        return User.query.get(int(user_id))
+        # Flask-Login keeps the result on g, so this runs at most once per request
+        return load_user_cached(int(user_id))
     
     # Register blueprints
     app.register_blueprint(auth_bp)
@@ -47,36 +95,121 @@ def create_app():
     
     return app
 
-app = create_app()
+app = create_app(config_by_name[os.environ.get('APP_CONFIG', 'default')])
+
+# Background queue for /api/process; without REDIS_URL jobs run inside the request
+processing_queue = None
+if Queue is not None and app.config['REDIS_URL']:
+    processing_queue = Queue('icaht', connection=Redis.from_url(app.config['REDIS_URL']))
 
 # Initialize processors
 data_processor = DataProcessor()
-icaht_grader = ICahtGrader()
+icaht_grader = ICahtGrader(cache_dir=app.config['GRADE_CACHE_FOLDER'])
 excel_handler = ExcelHandler()
 
-def log_audit(job_id, action, details=None):
+# Single thread for health check pings so a hung database can't block the request past its timeout
+health_executor = ThreadPoolExecutor(max_workers=1)
+health_ping = None  # the outstanding ping; later checks wait on it instead of queueing behind it
+health_ping_lock = threading.Lock()
+
+# PatientResult columns stored for each graded patient, with the value used when a column is missing
+PATIENT_RESULT_DEFAULTS = {
+    'patient_id': None,
+    'early_icaht_grade': None,
+    'duration_below_500_max': 0,
+    'duration_below_100_max': 0,
+    'grade_4_special': False,
+    'late_icaht_grade': None,
+    'anc_1': None,
+    'anc_2': None,
+    'anc_count': 0
+}
+
+# Narrower dtypes for the graded frame; ANC stays float64 to match the Float columns
+PATIENT_RESULT_DTYPES = {
+    'early_icaht_grade': 'category',
+    'late_icaht_grade': 'category',
+    'duration_below_500_max': 'int32',
+    'duration_below_100_max': 'int32',
+    'grade_4_special': 'bool',
+    'anc_count': 'int32'
+}
+
+def log_audit(job_id, action, details=None, user_id=None):
     """Helper function to log audit trail"""
-    audit = ProcessingAudit(
-        job_id=job_id,
-        user_id=current_user.id,
-        action=action,
-        ip_address=request.remote_addr,
-        user_agent=request.headers.get('User-Agent', '')[:255]
-    )
+    audit = {
+        'job_id': job_id,
+        'user_id': user_id,
+        'action': action,
+        'details': details or None,
+        'timestamp': datetime.utcnow()
+    }
     
-    if details:
-        audit.set_details(details)
+    if not has_request_context():
+        # Background jobs exit when done, so write straight away instead of queueing
+        db.session.bulk_insert_mappings(ProcessingAudit, [audit])
+        db.session.commit()
+        return
     
-    db.session.add(audit)
-    db.session.commit()
+    audit.update({
+        'user_id': user_id if user_id is not None else current_user.id,
+        'ip_address': request.remote_addr,
+        'user_agent': request.headers.get('User-Agent', '')[:255]
+    })
+    audit_writer.put(audit)
+
+def select_job_results(job_id):
+    """Core select of the result columns returned to clients, skipping ORM objects"""
+    columns = PatientResult.__table__.c
+    return db.select(
+        columns.patient_id, columns.early_icaht_grade, columns.late_icaht_grade,
+        columns.duration_below_500_max, columns.duration_below_100_max,
+        columns.grade_4_special, columns.anc_1, columns.anc_2, columns.anc_count
+    ).where(columns.job_id == job_id)
+
+def ping_database(engine):
+    """Run a trivial query on its own connection, outside the request session"""
+    with engine.connect() as conn:
+        return conn.scalar(text('SELECT 1'))
+
+def new_file_hasher():
+    """Hash used for duplicate detection; uploads and files on disk must agree"""
+    return hashlib.blake2b(digest_size=16)
 
 def calculate_file_hash(filepath):
-    """Calculate MD5 hash of file for duplicate detection"""
-    hash_md5 = hashlib.md5()
+    """Calculate BLAKE2b hash of file for duplicate detection"""
     with open(filepath, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
+        # Large files are hashed in one update over a memory map
+        if os.fstat(f.fileno()).st_size > 16 << 20:
+            file_hasher = new_file_hasher()
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                file_hasher.update(mm)
+            return file_hasher.digest()
+        
+        return hashlib.file_digest(f, new_file_hasher).digest()
+
+# Message prefix for unhandled errors in each JSON API endpoint
+API_ERROR_MESSAGES = {
+    'upload_file': 'File processing failed',
+    'process_icaht': 'Processing failed',
+    'get_job_history': 'Failed to load job history',
+    'get_job_results': 'Failed to load results',
+    'export_results': 'Export failed',
+    'get_sample_data': 'Sample data loading failed'
+}
+
+@app.errorhandler(Exception)
+def handle_unexpected_error(e):
+    """Return a JSON error for unhandled exceptions in API endpoints"""
+    if isinstance(e, HTTPException):
+        return e
+    
+    app.logger.exception(e)
+    message = API_ERROR_MESSAGES.get(request.endpoint)
+    if message is None:
+        return InternalServerError(original_exception=e)
+    
+    return jsonify({'error': f'{message}: {str(e)}'}), 500
 
 @app.route('/')
 @login_required
@@ -93,372 +226,413 @@ def index():
 @login_required
 def upload_file():
     """Handle file upload and initial validation - now with persistence"""
+    if 'file' not in request.files:
+        return jsonify({'error': 'No file uploaded'}), 400
+    
+    file = request.files['file']
+    if file.filename == '':
+        return jsonify({'error': 'No file selected'}), 400
+    
+    if not file.filename.lower().endswith(('.xlsx', '.xls')):
+        return jsonify({'error': 'Please upload an Excel file (.xlsx or .xls)'}), 400
+    
+    # Generate unique filename
+    file_id = str(uuid.uuid4())
+    filename = secure_filename(file.filename)
+    filepath = os.path.join(app.config['UPLOAD_FOLDER'], f"{file_id}_{filename}")
+    
+    # Hash the upload in chunks; UploadRequest has already spooled it to disk
+    file_hasher = new_file_hasher()
+    while chunk := file.stream.read(1 << 20):
+        file_hasher.update(chunk)
+    file_size = file.stream.tell()
+    file_hash = file_hasher.digest()
+    
+    # Check for duplicate files before anything is written to the upload folder
+    existing_job = ProcessingJob.query.filter_by(
+        user_id=current_user.id,
+        file_hash=file_hash
+    ).first()
+    
+    if existing_job:
+        return jsonify({
+            'warning': f'This file was already processed on {existing_job.created_at.strftime("%Y-%m-%d %H:%M")}',
+            'existing_job_id': existing_job.id,
+            'suggestion': 'Would you like to view the existing results instead?'
+        }), 409
+    
+    file.stream.seek(0)
+    with open(filepath, 'wb') as out:
+        shutil.copyfileobj(file.stream, out, length=1 << 20)
+    
+    # Validate file structure and load the data in a single read
+    df, validation_result = excel_handler.load_and_validate(filepath)
+    if not validation_result['valid']:
+        os.remove(filepath)  # Clean up invalid file
+        return jsonify({'error': validation_result['message']}), 400
+    
+    # Preview data
+    preview_data = df.head(10).to_dict('records')
+    
+    # Keep the parsed columns so processing doesn't have to parse the workbook again. Text
+    # columns mixing numbers and strings are stored as str, which pyarrow can write; if the
+    # write still fails, grade_job simply reads the workbook
+    parquet_path = f"{filepath}.parquet"
     try:
-        if 'file' not in request.files:
-            return jsonify({'error': 'No file uploaded'}), 400
-        
-        file = request.files['file']
-        if file.filename == '':
-            return jsonify({'error': 'No file selected'}), 400
-        
-        if not file.filename.lower().endswith(('.xlsx', '.xls')):
-            return jsonify({'error': 'Please upload an Excel file (.xlsx or .xls)'}), 400
-        
-        # Generate unique filename
-        file_id = str(uuid.uuid4())
-        filename = secure_filename(file.filename)
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], f"{file_id}_{filename}")
-        file.save(filepath)
-        
-        # Calculate file hash and size
-        file_hash = calculate_file_hash(filepath)
-        file_size = os.path.getsize(filepath)
-        
-        # Check for duplicate files
-        existing_job = ProcessingJob.query.filter_by(
-            user_id=current_user.id,
-            file_hash=file_hash
-        ).first()
-        
-        if existing_job:
-            os.remove(filepath)  # Clean up uploaded file
-            return jsonify({
-                'warning': f'This file was already processed on {existing_job.created_at.strftime("%Y-%m-%d %H:%M")}',
-                'existing_job_id': existing_job.id,
-                'suggestion': 'Would you like to view the existing results instead?'
-            }), 409
-        
-        # Validate file structure
-        validation_result = excel_handler.validate_file(filepath)
-        if not validation_result['valid']:
-            os.remove(filepath)  # Clean up invalid file
-            return jsonify({'error': validation_result['message']}), 400
-        
-        # Load and preview data
+        sidecar = df[excel_handler.required_columns]
+        sidecar = sidecar.astype(dict.fromkeys(sidecar.select_dtypes('object').columns, str))
+        sidecar.to_parquet(parquet_path, compression='zstd')
+    except Exception:
+        if os.path.exists(parquet_path):
+            os.remove(parquet_path)
+    
+    # Create processing job record
+    job_name = f"ICAHT Analysis - {datetime.now().strftime('%Y-%m-%d %H:%M')}"
+    job = ProcessingJob(
+        user_id=current_user.id,
+        job_name=job_name,
+        original_filename=file.filename,
+        file_hash=file_hash,
+        file_size=file_size,
+        stored_path=filepath,
+        status='uploaded'
+    )
+    
+    db.session.add(job)
+    db.session.commit()
+    
+    # load_data drops rows without a patient_id, so unique() matches nunique() without its NaN handling
+    row_count = len(df)
+    patient_count = df['patient_id'].unique().size if 'patient_id' in df.columns else 0
+    
+    # Log audit trail
+    log_audit(job.id, 'upload', {
+        'filename': file.filename,
+        'file_size': file_size,
+        'row_count': row_count,
+        'patient_count': patient_count
+    })
+    
+    return jsonify({
+        'job_id': job.id,
+        'file_id': file_id,  # Still needed for backward compatibility
+        'filename': file.filename,
+        'row_count': row_count,
+        'preview': preview_data,
+        'columns': list(df.columns),
+        'patients': patient_count
+    })
+
+def mark_job_failed(job, error):
+    """Record a processing failure on the job and in the audit trail"""
+    db.session.rollback()
+    job.status = 'failed'
+    job.error_message = str(error)
+    job.completed_at = datetime.utcnow()
+    db.session.commit()
+    
+    log_audit(job.id, 'process_error', {'error': str(error)}, user_id=job.user_id)
+
+def grade_job(job):
+    """Load, grade and store results for a job using its saved settings"""
+    settings = job.get_settings()
+    filepath = job.stored_path
+    
+    job.status = 'processing'
+    job.started_at = datetime.utcnow()
+    db.session.commit()
+    
+    # Load data, preferring the parsed copy saved at upload time
+    parquet_path = f"{filepath}.parquet"
+    if os.path.exists(parquet_path):
+        df = pd.read_parquet(parquet_path)
+    else:
         df = excel_handler.load_data(filepath)
-        preview_data = df.head(10).to_dict('records')
-        
-        # Create processing job record
-        job_name = f"ICAHT Analysis - {datetime.now().strftime('%Y-%m-%d %H:%M')}"
-        job = ProcessingJob(
-            user_id=current_user.id,
-            job_name=job_name,
-            original_filename=file.filename,
-            file_hash=file_hash,
-            file_size=file_size,
-            status='uploaded'
-        )
-        
-        db.session.add(job)
-        db.session.commit()
-        
-        # Log audit trail
-        log_audit(job.id, 'upload', {
-            'filename': file.filename,
-            'file_size': file_size,
-            'row_count': len(df),
-            'patient_count': df['patient_id'].nunique() if 'patient_id' in df.columns else 0
-        })
-        
-        return jsonify({
-            'job_id': job.id,
-            'file_id': file_id,  # Still needed for backward compatibility
-            'filename': file.filename,
-            'row_count': len(df),
-            'preview': preview_data,
-            'columns': list(df.columns),
-            'patients': df['patient_id'].nunique() if 'patient_id' in df.columns else 0
-        })
-        
+    
+    # Process data
+    processed_data = data_processor.prepare_data(df, settings)
+    
+    # Grade ICAHT
+    early_grades = icaht_grader.grade_early_icaht(processed_data['early'])
+    late_grades = icaht_grader.grade_late_icaht(processed_data['late'])
+    
+    # Combine results
+    final_grades = icaht_grader.combine_grades(early_grades, late_grades)
+    final_grades = final_grades.assign(**{
+        col: default for col, default in PATIENT_RESULT_DEFAULTS.items()
+        if col not in final_grades.columns
+    })[list(PATIENT_RESULT_DEFAULTS)].astype(PATIENT_RESULT_DTYPES)
+    
+    # Store results in database; NaN nadirs (no late readings) become NULL, which PostgreSQL
+    # would otherwise keep as NaN and the export could not write
+    stored_grades = final_grades.astype(object).where(final_grades.notna(), None)
+    result_records = [
+        dict(zip(PATIENT_RESULT_DEFAULTS, row), job_id=job.id)
+        for row in stored_grades.itertuples(index=False, name=None)
+    ]
+    db.session.bulk_insert_mappings(PatientResult, result_records)
+    
+    # Update job completion
+    job.status = 'completed'
+    job.completed_at = datetime.utcnow()
+    job.total_patients = len(final_grades)
+    job.grade_4_special_cases = int(final_grades['grade_4_special'].sum())
+    db.session.commit()
+    
+    # Generate summary statistics
+    summary = icaht_grader.generate_summary(final_grades, processed_data)
+    
+    # Log processing completion
+    log_audit(job.id, 'process_complete', {
+        'total_patients': len(final_grades),
+        'summary': summary
+    }, user_id=job.user_id)
+    
+    # Clean up uploaded file
+    os.remove(filepath)
+    if os.path.exists(parquet_path):
+        os.remove(parquet_path)
+    
+    return final_grades, summary
+
+@contextmanager
+def job_failure_guard(job):
+    """Mark the job failed if the enclosed block raises, then re-raise"""
+    try:
+        yield
     except Exception as e:
-        return jsonify({'error': f'File processing failed: {str(e)}'}), 500
+        mark_job_failed(job, e)
+        raise
+
+def run_icaht_job(job_id):
+    """Background worker entry point for a queued processing job"""
+    with app.app_context():
+        job = db.session.get(ProcessingJob, job_id)
+        with job_failure_guard(job):
+            grade_job(job)
 
 @app.route('/api/process', methods=['POST'])
 @login_required
 def process_icaht():
-    """Process ICAHT grading - now with database persistence"""
-    try:
-        data = request.get_json()
-        job_id = data.get('job_id')
-        settings = data.get('settings', {})
-        
-        if not job_id:
-            return jsonify({'error': 'Job ID required'}), 400
-        
-        # Get job and verify ownership
-        job = ProcessingJob.query.filter_by(id=job_id, user_id=current_user.id).first()
-        if not job:
-            return jsonify({'error': 'Job not found or access denied'}), 404
-        
-        # Find uploaded file
-        upload_dir = app.config['UPLOAD_FOLDER']
-        filepath = None
-        for filename in os.listdir(upload_dir):
-            if filename.startswith(f"{data.get('file_id', '')}_"):
-                filepath = os.path.join(upload_dir, filename)
-                break
-        
-        if not filepath or not os.path.exists(filepath):
-            return jsonify({'error': 'File not found'}), 404
-        
-        # Update job status and settings
-        job.status = 'processing'
-        job.started_at = datetime.utcnow()
+    """Process ICAHT grading - queued on the background worker when one is configured"""
+    data = request.get_json()
+    job_id = data.get('job_id')
+    settings = data.get('settings', {})
+    
+    if not job_id:
+        return jsonify({'error': 'Job ID required'}), 400
+    
+    # Get job and verify ownership
+    job = ProcessingJob.query.filter_by(id=job_id, user_id=current_user.id).first()
+    if not job:
+        return jsonify({'error': 'Job not found or access denied'}), 404
+    
+    # Locate uploaded file
+    filepath = job.stored_path
+    if not filepath or not os.path.exists(filepath):
+        return jsonify({'error': 'File not found'}), 404
+    
+    with job_failure_guard(job):
+        # Save settings for the grading run
         job.set_settings(settings)
         db.session.commit()
         
         # Log processing start
         log_audit(job.id, 'process_start', {'settings': settings})
         
-        # Load data
-        df = excel_handler.load_data(filepath)
-        
-        # Process data
-        processed_data = data_processor.prepare_data(df, settings)
-        
-        # Grade ICAHT
-        early_grades = icaht_grader.grade_early_icaht(processed_data['early'])
-        late_grades = icaht_grader.grade_late_icaht(processed_data['late'])
-        
-        # Combine results
-        final_grades = icaht_grader.combine_grades(early_grades, late_grades)
-        
-        # Store results in database
-        for _, row in final_grades.iterrows():
-            result = PatientResult(
-                job_id=job.id,
-                patient_id=row['patient_id'],
-                early_icaht_grade=row.get('early_icaht_grade'),
-                duration_below_500_max=row.get('duration_below_500_max', 0),
-                duration_below_100_max=row.get('duration_below_100_max', 0),
-                grade_4_special=row.get('grade_4_special', False),
-                late_icaht_grade=row.get('late_icaht_grade'),
-                anc_1=row.get('anc_1'),
-                anc_2=row.get('anc_2'),
-                anc_count=row.get('anc_count', 0)
-            )
-            db.session.add(result)
-        
-        # Update job completion
-        job.status = 'completed'
-        job.completed_at = datetime.utcnow()
-        job.total_patients = len(final_grades)
-        job.grade_4_special_cases = final_grades.get('grade_4_special', False).sum()
-        db.session.commit()
-        
-        # Generate summary statistics
-        summary = icaht_grader.generate_summary(final_grades, processed_data)
-        
-        # Log processing completion
-        log_audit(job.id, 'process_complete', {
-            'total_patients': len(final_grades),
-            'summary': summary
-        })
+        if processing_queue is not None:
+            job.status = 'queued'
+            db.session.commit()
+            processing_queue.enqueue(run_icaht_job, job.id, job_timeout=app.config['PROCESSING_JOB_TIMEOUT'])
+            
+            # Client polls /api/job-results/<job_id> until the job completes
+            return jsonify({'job_id': job.id, 'status': 'queued'}), 202
         
-        # Clean up uploaded file
-        os.remove(filepath)
+        final_grades, summary = grade_job(job)
         
         return jsonify({
             'success': True,
             'job_id': job.id,
             'results': final_grades.to_dict('records'),
             'summary': summary,
-            'processed_at': datetime.now().isoformat()
+            'processed_at': datetime.now()
         })
-        
-    except Exception as e:
-        # Update job with error
-        if 'job' in locals():
-            job.status = 'failed'
-            job.error_message = str(e)
-            job.completed_at = datetime.utcnow()
-            db.session.commit()
-            
-            log_audit(job.id, 'process_error', {'error': str(e)})
-        
-        return jsonify({'error': f'Processing failed: {str(e)}'}), 500
 
 @app.route('/api/job-history')
 @login_required
 def get_job_history():
     """Get user's processing job history"""
-    try:
-        page = request.args.get('page', 1, type=int)
-        per_page = request.args.get('per_page', 20, type=int)
-        
-        jobs_query = ProcessingJob.query.filter_by(user_id=current_user.id)\
-                                      .order_by(ProcessingJob.created_at.desc())
+    page = request.args.get('page', 1, type=int)
+    per_page = request.args.get('per_page', 20, type=int)
+    
+    jobs_query = ProcessingJob.query.filter_by(user_id=current_user.id)\
+                                  .order_by(ProcessingJob.created_at.desc())
+    
+    jobs_paginated = jobs_query.paginate(
+        page=page, 
+        per_page=per_page, 
+        error_out=False
+    )
+    
+    jobs_data = []
+    for job in jobs_paginated.items:
+        job_data = {
+            'id': job.id,
+            'job_name': job.job_name,
+            'original_filename': job.original_filename,
+            'status': job.status,
+            'created_at': job.created_at,
+            'total_patients': job.total_patients,
+            'grade_4_special_cases': job.grade_4_special_cases
+        }
         
-        jobs_paginated = jobs_query.paginate(
-            page=page, 
-            per_page=per_page, 
-            error_out=False
-        )
+        if job.completed_at:
+            job_data['completed_at'] = job.completed_at
+            duration = job.get_duration()
+            if duration:
+                job_data['duration_seconds'] = duration.total_seconds()
         
-        jobs_data = []
-        for job in jobs_paginated.items:
-            job_data = {
-                'id': job.id,
-                'job_name': job.job_name,
-                'original_filename': job.original_filename,
-                'status': job.status,
-                'created_at': job.created_at.isoformat(),
-                'total_patients': job.total_patients,
-                'grade_4_special_cases': job.grade_4_special_cases
-            }
-            
-            if job.completed_at:
-                job_data['completed_at'] = job.completed_at.isoformat()
-                duration = job.get_duration()
-                if duration:
-                    job_data['duration_seconds'] = duration.total_seconds()
-            
-            if job.error_message:
-                job_data['error_message'] = job.error_message
-            
-            jobs_data.append(job_data)
+        if job.error_message:
+            job_data['error_message'] = job.error_message
         
-        return jsonify({
-            'jobs': jobs_data,
-            'pagination': {
-                'page': page,
-                'per_page': per_page,
-                'total': jobs_paginated.total,
-                'pages': jobs_paginated.pages,
-                'has_next': jobs_paginated.has_next,
-                'has_prev': jobs_paginated.has_prev
-            }
-        })
-        
-    except Exception as e:
-        return jsonify({'error': f'Failed to load job history: {str(e)}'}), 500
+        jobs_data.append(job_data)
+    
+    return jsonify({
+        'jobs': jobs_data,
+        'pagination': {
+            'page': page,
+            'per_page': per_page,
+            'total': jobs_paginated.total,
+            'pages': jobs_paginated.pages,
+            'has_next': jobs_paginated.has_next,
+            'has_prev': jobs_paginated.has_prev
+        }
+    })
 
 @app.route('/api/job-results/<int:job_id>')
 @login_required
 def get_job_results(job_id):
     """Get results for a specific job"""
-    try:
-        # Verify job ownership
-        job = ProcessingJob.query.filter_by(id=job_id, user_id=current_user.id).first()
-        if not job:
-            return jsonify({'error': 'Job not found or access denied'}), 404
-        
-        if job.status != 'completed':
-            return jsonify({'error': 'Job is not completed'}), 400
-        
-        # Get results
-        results = PatientResult.query.filter_by(job_id=job_id).all()
-        
-        results_data = [result.to_dict() for result in results]
-        
-        # Generate summary from stored data
-        summary = {
-            'total_patients': job.total_patients,
-            'grade_4_special_cases': job.grade_4_special_cases,
-            'job_info': {
-                'name': job.job_name,
-                'created_at': job.created_at.isoformat(),
-                'completed_at': job.completed_at.isoformat(),
-                'settings': job.get_settings()
-            }
+    # Verify job ownership
+    job = ProcessingJob.query.filter_by(id=job_id, user_id=current_user.id).first()
+    if not job:
+        return jsonify({'error': 'Job not found or access denied'}), 404
+    
+    if job.status != 'completed':
+        return jsonify({'error': 'Job is not completed'}), 400
+    
+    # Get results
+    rows = db.session.execute(select_job_results(job_id)).mappings().all()
+    results_data = [dict(row) for row in rows]
+    
+    # Generate summary from stored data
+    summary = {
+        'total_patients': job.total_patients,
+        'grade_4_special_cases': job.grade_4_special_cases,
+        'job_info': {
+            'name': job.job_name,
+            'created_at': job.created_at,
+            'completed_at': job.completed_at,
+            'settings': job.get_settings()
         }
-        
-        # Log view action
-        log_audit(job.id, 'view_results')
-        
-        return jsonify({
-            'results': results_data,
-            'summary': summary
-        })
-        
-    except Exception as e:
-        return jsonify({'error': f'Failed to load results: {str(e)}'}), 500
+    }
+    
+    # Log view action
+    log_audit(job.id, 'view_results')
+    
+    return jsonify({
+        'results': results_data,
+        'summary': summary
+    })
 
 @app.route('/api/export', methods=['POST'])
 @login_required
 def export_results():
     """Export results to Excel - with audit logging"""
-    try:
-        data = request.get_json()
-        job_id = data.get('job_id')
+    data = request.get_json()
+    job_id = data.get('job_id')
+    
+    output = io.BytesIO()
+    
+    if job_id:
+        # Export specific job
+        job = ProcessingJob.query.filter_by(id=job_id, user_id=current_user.id).first()
+        if not job:
+            return jsonify({'error': 'Job not found or access denied'}), 404
         
-        if job_id:
-            # Export specific job
-            job = ProcessingJob.query.filter_by(id=job_id, user_id=current_user.id).first()
-            if not job:
-                return jsonify({'error': 'Job not found or access denied'}), 404
-            
-            results = PatientResult.query.filter_by(job_id=job_id).all()
-            results_df = pd.DataFrame([result.to_dict() for result in results])
-            
-            log_audit(job.id, 'export')
-        else:
-            # Legacy: export from provided results data
-            results_data = data.get('results', [])
-            if not results_data:
-                return jsonify({'error': 'No results to export'}), 400
-            
-            results_df = pd.DataFrame(results_data)
+        # Stream rows from the database straight into the workbook
+        query = select_job_results(job_id).execution_options(yield_per=5000)
+        rows = db.session.execute(query)
+        exported = excel_handler.export_results(list(rows.keys()), rows, output)
         
-        if results_df.empty:
+        log_audit(job.id, 'export')
+    else:
+        # Legacy: export from provided results data
+        results_data = data.get('results', [])
+        if not results_data:
             return jsonify({'error': 'No results to export'}), 400
         
-        # Create Excel file in memory
-        output = io.BytesIO()
-        excel_handler.export_results(results_df, output)
-        output.seek(0)
-        
-        # Encode for download
-        excel_data = base64.b64encode(output.getvalue()).decode()
-        
-        filename = f'ICAHT_Grades_{datetime.now().strftime("%Y%m%d_%H%M%S")}.xlsx'
-        
-        return jsonify({
-            'excel_data': excel_data,
-            'filename': filename
-        })
-        
-    except Exception as e:
-        return jsonify({'error': f'Export failed: {str(e)}'}), 500
+        results_df = pd.DataFrame(results_data)
+        results_df = results_df.astype(object).where(results_df.notna(), None)
+        exported = excel_handler.export_results(
+            list(results_df.columns), results_df.itertuples(index=False, name=None), output
+        )
+    
+    if not exported:
+        return jsonify({'error': 'No results to export'}), 400
+    
+    output.seek(0)
+    
+    filename = f'ICAHT_Grades_{datetime.now().strftime("%Y%m%d_%H%M%S")}.xlsx'
+    
+    return send_file(
+        output,
+        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        as_attachment=True,
+        download_name=filename
+    )
 
 @app.route('/api/sample-data')
 @login_required
 def get_sample_data():
     """Provide sample data for testing"""
-    try:
-        sample_file = os.path.join('sample_data', 'Synthetic_ANC_Dataset.xlsx')
-        if not os.path.exists(sample_file):
-            return jsonify({'error': 'Sample data not available'}), 404
-        
-        df = excel_handler.load_data(sample_file)
-        
-        return jsonify({
-            'data': df.to_dict('records'),
-            'columns': list(df.columns),
-            'row_count': len(df),
-            'patients': df['patient_id'].nunique()
-        })
-        
-    except Exception as e:
-        return jsonify({'error': f'Sample data loading failed: {str(e)}'}), 500
+    sample_file = os.path.join('sample_data', 'Synthetic_ANC_Dataset.xlsx')
+    if not os.path.exists(sample_file):
+        return jsonify({'error': 'Sample data not available'}), 404
+    
+    df = excel_handler.load_data(sample_file, cached=True)
+    
+    return jsonify({
+        'data': df.to_dict('records'),
+        'columns': list(df.columns),
+        'row_count': len(df),
+        'patients': df['patient_id'].nunique()
+    })
 
 @app.route('/health')
 def health_check():
     """Health check endpoint for monitoring"""
+    global health_ping
+    
+    # Test database connection, sharing a ping that hasn't finished yet
+    with health_ping_lock:
+        if health_ping is None or health_ping.done():
+            health_ping = health_executor.submit(ping_database, db.engine)
+        ping = health_ping
+    
     try:
-        # Test database connection
-        db.session.execute('SELECT 1')
+        ping.result(timeout=app.config['HEALTH_CHECK_TIMEOUT'])
         
         return jsonify({
             'status': 'healthy',
-            'timestamp': datetime.utcnow().isoformat(),
+            'timestamp': datetime.utcnow(),
             'version': '1.0.0'
         })
     except Exception as e:
         return jsonify({
             'status': 'unhealthy',
-            'error': str(e),
-            'timestamp': datetime.utcnow().isoformat()
+            'error': 'timeout' if isinstance(e, TimeoutError) else str(e),
+            'timestamp': datetime.utcnow()
         }), 500
 
 if __name__ == '__main__':
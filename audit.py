@@ -0,0 +1,77 @@
+# audit.py - Background writer for the processing audit trail
+import atexit
+import os
+import queue
+import threading
+import time
+
+from models import db, ProcessingAudit
+
+class AuditWriter:
+    """Batch audit rows onto a background thread so requests don't wait on the commit"""
+
+    def __init__(self, app=None, batch_size=100, flush_interval=0.1):
+        self.app = app
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = None
+        self._pid = None
+        self._lock = threading.Lock()
+        atexit.register(self.flush)
+
+    def init_app(self, app):
+        """Bind the writer to the app whose database receives the rows"""
+        self.app = app
+
+    def put(self, mapping):
+        """Queue one ProcessingAudit row mapping for writing"""
+        self._ensure_thread()
+        self._queue.put(mapping)
+
+    def flush(self):
+        """Write anything still queued in this process"""
+        if self._queue is None or self._pid != os.getpid():
+            return
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if batch:
+            self._write(batch)
+
+    def _ensure_thread(self):
+        """Start the writer thread, once per process (threads don't survive a fork)"""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = queue.SimpleQueue()
+                threading.Thread(target=self._run, name='audit-writer', daemon=True).start()
+                self._pid = os.getpid()
+
+    def _run(self):
+        """Collect up to batch_size rows or flush_interval seconds, then insert them together"""
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._write(batch)
+
+    def _write(self, batch):
+        """Insert a batch of audit rows in one transaction"""
+        with self.app.app_context():
+            try:
+                db.session.bulk_insert_mappings(ProcessingAudit, batch)
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                self.app.logger.error(f'Failed to write {len(batch)} audit rows: {e}')
@@ -1,17 +1,74 @@
 # auth.py - Authentication blueprint with login/logout
-from flask import Blueprint, render_template, request, flash, redirect, url_for, jsonify
+from flask import Blueprint, render_template, request, flash, redirect, url_for, jsonify, session, current_app, abort
 from flask_login import login_user, logout_user, login_required, current_user
-from models import db, User, create_user
-from functools import wraps
+from flask_caching import Cache
+from flask_limiter import Limiter
+from models import db, User, ProcessingJob, create_user
+from sqlalchemy import func, select, update
+from sqlalchemy.orm import make_transient_to_detached, raiseload
+from functools import wraps, lru_cache
+import hashlib
+import re
+from hmac import compare_digest
 
 # Create authentication blueprint
 auth_bp = Blueprint('auth', __name__, url_prefix='/auth')
 
+# Cross-request cache, initialised in create_app
+cache = Cache()
+
+def credential_rate_key():
+    """Rate-limit key for credential endpoints: client address plus the username tried"""
+    data = (request.get_json(silent=True) or {}) if request.is_json else request.form
+    return f"{request.remote_addr}:{data.get('username', '')}"
+
+# Caps password attempts before they reach the hasher, initialised in create_app
+limiter = Limiter(key_func=credential_rate_key)
+
+def auth_rate_limit():
+    """Configured limit for login/register POSTs"""
+    return current_app.config['AUTH_RATE_LIMIT']
+
+ADMIN_USERS_PAGE_SIZE = 50
+
+USERNAME_PATTERN = re.compile(r'^[A-Za-z0-9_.-]{3,80}$')
+EMAIL_PATTERN = re.compile(r'^[^@\s]+@[^@\s]+\.[^@\s]+$')
+
+# User columns kept in the (possibly shared) cache; never the password hash or email
+CACHED_USER_COLUMNS = (User.id, User.username, User.role, User.is_admin, User.is_active,
+                       User.created_at, User.last_login)
+
+@cache.memoize()  # CACHE_DEFAULT_TIMEOUT: 60s when shared through Redis, 5s per process
+def load_user_fields(user_id):
+    """Fields current_user needs for a user id, cached briefly so each request doesn't hit the database"""
+    row = db.session.execute(select(*CACHED_USER_COLUMNS).where(User.id == user_id)).mappings().first()
+    return dict(row) if row else None
+
+def load_user_cached(user_id):
+    """Session-attached User built from the cached fields; other columns load on first access"""
+    fields = load_user_fields(user_id)
+    if fields is None:
+        return None
+    user = User(**fields)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+def registration_errors(username, email, password, confirm_password):
+    """Yield each registration validation error in turn"""
+    if not USERNAME_PATTERN.match(username):
+        yield 'Username must be 3-80 characters: letters, digits, . _ or -'
+    if not EMAIL_PATTERN.match(email):
+        yield 'Valid email address is required'
+    if len(password) < 6:
+        yield 'Password must be at least 6 characters long'
+    if not compare_digest(password.encode('utf-8'), confirm_password.encode('utf-8')):
+        yield 'Passwords do not match'
+
 def admin_required(f):
     """Decorator to require admin role for certain routes"""
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if not current_user.is_authenticated or current_user.role != 'admin':
+        if not current_user.is_authenticated or not current_user.is_admin:
             if request.is_json:
                 return jsonify({'error': 'Admin access required'}), 403
             flash('Admin access required', 'error')
@@ -20,6 +77,7 @@ def admin_required(f):
     return decorated_function
 
 @auth_bp.route('/login', methods=['GET', 'POST'])
+@limiter.limit(auth_rate_limit, methods=['POST'])
 def login():
     """Handle user login"""
     if current_user.is_authenticated:
@@ -41,7 +99,7 @@ def login():
             if request.is_json:
                 return jsonify({'error': error_msg}), 400
             flash(error_msg, 'error')
-            return render_template('auth/login.html')
+            return render_template('auth/login.html'), 400
         
         # Find user by username or email
         user = User.query.filter(
@@ -50,8 +108,13 @@ def login():
         
         if user and user.check_password(password):
             # Successful login
+            if user.needs_rehash():
+                user.set_password(password)
+            
             login_user(user, remember=True)
             user.update_last_login()
+            db.session.commit()  # one commit for the login stamp and any rehash
+            cache.delete_memoized(load_user_fields, user.id)
             
             if request.is_json:
                 return jsonify({
@@ -76,6 +139,7 @@ def login():
             if request.is_json:
                 return jsonify({'error': error_msg}), 401
             flash(error_msg, 'error')
+            return render_template('auth/login.html'), 401
     
     # GET request - show login form
     return render_template('auth/login.html')
@@ -85,11 +149,15 @@ def login():
 def logout():
     """Handle user logout"""
     username = current_user.username
+    cache.delete_memoized(load_user_fields, current_user.id)
+    # Clear first: logout_user leaves a marker in the session to drop the remember-me cookie
+    session.clear()
     logout_user()
     flash(f'You have been logged out. Goodbye, {username}!', 'info')
     return redirect(url_for('auth.login'))
 
 @auth_bp.route('/register', methods=['GET', 'POST'])
+@limiter.limit(auth_rate_limit, methods=['POST'])
 def register():
     """Handle user registration (if enabled)"""
     # You can disable registration in production by adding a check here
@@ -112,27 +180,18 @@ def register():
             password = request.form.get('password', '')
             confirm_password = request.form.get('confirm_password', '')
         
-        # Validation
-        errors = []
-        if not username or len(username) < 3:
-            errors.append('Username must be at least 3 characters long')
-        
-        if not email or '@' not in email:
-            errors.append('Valid email address is required')
-        
-        if not password or len(password) < 6:
-            errors.append('Password must be at least 6 characters long')
-        
-        if password != confirm_password:
-            errors.append('Passwords do not match')
-        
-        if errors:
-            error_msg = '; '.join(errors)
-            if request.is_json:
+        # Validation - JSON callers only get the first error, so stop there
+        errors = registration_errors(username, email, password, confirm_password)
+        if request.is_json:
+            error_msg = next(errors, None)
+            if error_msg:
                 return jsonify({'error': error_msg}), 400
-            for error in errors:
-                flash(error, 'error')
-            return render_template('auth/register.html')
+        else:
+            errors = list(errors)
+            if errors:
+                for error in errors:
+                    flash(error, 'error')
+                return render_template('auth/register.html')
         
         # Create user
         user, message = create_user(username, email, password)
@@ -160,30 +219,57 @@ def register():
 @login_required
 def profile():
     """User profile page"""
-    # Get user's job history
-    jobs = current_user.processing_jobs[:10]  # Last 10 jobs
-    
-    return render_template('auth/profile.html', user=current_user, jobs=jobs)
+    # Last 10 jobs, with the user's total job count riding along as a window column
+    jobs = db.session.execute(
+        select(ProcessingJob.id, ProcessingJob.job_name, ProcessingJob.original_filename,
+               ProcessingJob.status, ProcessingJob.created_at, ProcessingJob.completed_at,
+               ProcessingJob.total_patients, func.count().over().label('total'))
+        .where(ProcessingJob.user_id == current_user.id)
+        .order_by(ProcessingJob.created_at.desc())
+        .limit(10)
+    ).all()
+    
+    total_jobs = jobs[0].total if jobs else 0
+    return render_template('auth/profile.html', user=current_user, jobs=jobs, total_jobs=total_jobs)
+
+@lru_cache(maxsize=1024)
+def user_info_body(user_id, username, email, role, last_login, created_at):
+    """Serialized user-info payload and its ETag; keyed on every field, so edits miss the cache"""
+    body = current_app.json.dumps({
+        'user_id': user_id,
+        'username': username,
+        'email': email,
+        'role': role,
+        'last_login': last_login,
+        'created_at': created_at
+    }).encode()
+    return hashlib.blake2b(body, digest_size=16).hexdigest(), body
 
 @auth_bp.route('/api/user-info')
 @login_required
 def user_info():
     """API endpoint to get current user info"""
-    return jsonify({
-        'user_id': current_user.id,
-        'username': current_user.username,
-        'email': current_user.email,
-        'role': current_user.role,
-        'last_login': current_user.last_login.isoformat() if current_user.last_login else None,
-        'created_at': current_user.created_at.isoformat()
-    })
+    etag, body = user_info_body(current_user.id, current_user.username, current_user.email,
+                                current_user.role, current_user.last_login, current_user.created_at)
+    if request.if_none_match.contains(etag):
+        return '', 304
+    
+    response = current_app.response_class(body, mimetype='application/json')
+    response.set_etag(etag)
+    return response
 
 @auth_bp.route('/admin/users')
 @admin_required
 def admin_users():
     """Admin page to manage users"""
-    users = User.query.all()
-    return render_template('auth/admin_users.html', users=users)
+    # Keyset pagination: ?after=<last user id on the previous page>
+    after = request.args.get('after', 0, type=int)
+    users = db.session.query(
+        User.id, User.username, User.email, User.role, User.is_active, User.last_login
+    ).filter(User.id > after).order_by(User.id).limit(ADMIN_USERS_PAGE_SIZE).all()
+    
+    next_after = users[-1].id if len(users) == ADMIN_USERS_PAGE_SIZE else None
+    return render_template('auth/admin_users.html', users=users, next_after=next_after)
 
 @auth_bp.route('/admin/users/<int:user_id>/toggle-status', methods=['POST'])
 @admin_required
@@ -192,9 +278,11 @@ def toggle_user_status(user_id):
     if user_id == current_user.id:
         return jsonify({'error': 'Cannot modify your own account'}), 400
     
-    user = User.query.get_or_404(user_id)
+    # Row lock until commit, so two admins toggling at once can't both flip from the same state
+    user = db.session.get(User, user_id, options=[raiseload('*')], with_for_update=True) or abort(404)
     user.is_active = not user.is_active
     db.session.commit()
+    cache.delete_memoized(load_user_fields, user.id)
     
     status = 'activated' if user.is_active else 'deactivated'
     flash(f'User {user.username} has been {status}', 'success')
@@ -204,6 +292,42 @@ def toggle_user_status(user_id):
     
     return redirect(url_for('auth.admin_users'))
 
+@auth_bp.route('/admin/users/bulk-toggle', methods=['POST'])
+@admin_required
+def bulk_set_user_status():
+    """Activate or deactivate several users in one UPDATE"""
+    if request.is_json:
+        data = request.get_json()
+        ids, active = data.get('ids'), data.get('active')
+    else:
+        ids, active = request.form.getlist('ids', type=int), request.form.get('active') == 'true'
+    
+    if not isinstance(ids, list) or not all(isinstance(i, int) for i in ids) or not isinstance(active, bool):
+        error_msg = 'Expected a list of user ids and a boolean active flag'
+        if request.is_json:
+            return jsonify({'error': error_msg}), 400
+        flash(error_msg, 'error')
+        return redirect(url_for('auth.admin_users'))
+    
+    # Your own account is skipped, as in toggle_user_status
+    updated = db.session.execute(
+        update(User)
+        .where(User.id.in_(ids), User.id != current_user.id)
+        .values(is_active=active)
+        .returning(User.id)
+    ).scalars().all()
+    db.session.commit()
+    for user_id in updated:
+        cache.delete_memoized(load_user_fields, user_id)
+    
+    status = 'activated' if active else 'deactivated'
+    flash(f'{len(updated)} users have been {status}', 'success')
+    
+    if request.is_json:
+        return jsonify({'success': True, 'updated': updated, 'is_active': active})
+    
+    return redirect(url_for('auth.admin_users'))
+
 @auth_bp.route('/admin/create-user', methods=['POST'])
 @admin_required
 def admin_create_user():
@@ -234,203 +358,4 @@ def admin_create_user():
             return jsonify({'error': message}), 400
         flash(message, 'error')
     
-    return redirect(url_for('auth.admin_users'))# models.py - Complete database models for authentication and persistence
-from flask_sqlalchemy import SQLAlchemy
-from flask_login import UserMixin
-from datetime import datetime
-from werkzeug.security import generate_password_hash, check_password_hash
-import json
-
-db = SQLAlchemy()
-
-class User(UserMixin, db.Model):
-    """User model for authentication"""
-    __tablename__ = 'users'
-    
-    id = db.Column(db.Integer, primary_key=True)
-    username = db.Column(db.String(80), unique=True, nullable=False)
-    email = db.Column(db.String(120), unique=True, nullable=False)
-    password_hash = db.Column(db.String(255), nullable=False)
-    role = db.Column(db.String(20), default='user')  # 'user' or 'admin'
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    last_login = db.Column(db.DateTime)
-    is_active = db.Column(db.Boolean, default=True)
-    
-    # Relationship to processing jobs
-    processing_jobs = db.relationship('ProcessingJob', backref='user', cascade='all, delete-orphan')
-    
-    def set_password(self, password):
-        """Hash and set password"""
-        self.password_hash = generate_password_hash(password)
-    
-    def check_password(self, password):
-        """Check if provided password matches hash"""
-        return check_password_hash(self.password_hash, password)
-    
-    def update_last_login(self):
-        """Update last login timestamp"""
-        self.last_login = datetime.utcnow()
-        db.session.commit()
-    
-    def __repr__(self):
-        return f'<User {self.username}>'
-
-class ProcessingJob(db.Model):
-    """Track processing jobs and their results"""
-    __tablename__ = 'processing_jobs'
-    
-    id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
-    
-    # Job details
-    job_name = db.Column(db.String(255), nullable=False)
-    original_filename = db.Column(db.String(255), nullable=False)
-    status = db.Column(db.String(50), default='pending')  # pending, processing, completed, failed
-    
-    # Timestamps
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    started_at = db.Column(db.DateTime)
-    completed_at = db.Column(db.DateTime)
-    
-    # Error handling
-    error_message = db.Column(db.Text)
-    
-    # Processing settings (stored as JSON)
-    settings = db.Column(db.Text)
-    
-    # Results summary
-    total_patients = db.Column(db.Integer, default=0)
-    grade_4_special_cases = db.Column(db.Integer, default=0)
-    
-    # File information
-    file_size = db.Column(db.Integer)  # in bytes
-    file_hash = db.Column(db.String(64))  # for duplicate detection
-    
-    # Relationships
-    results = db.relationship('PatientResult', backref='job', cascade='all, delete-orphan')
-    audit_logs = db.relationship('ProcessingAudit', backref='job', cascade='all, delete-orphan')
-    
-    def set_settings(self, settings_dict):
-        """Store settings as JSON string"""
-        self.settings = json.dumps(settings_dict)
-    
-    def get_settings(self):
-        """Retrieve settings from JSON string"""
-        if self.settings:
-            return json.loads(self.settings)
-        return {}
-    
-    def get_duration(self):
-        """Calculate processing duration"""
-        if self.started_at and self.completed_at:
-            return self.completed_at - self.started_at
-        return None
-    
-    def __repr__(self):
-        return f'<ProcessingJob {self.id}: {self.job_name}>'
-
-class PatientResult(db.Model):
-    """Store individual patient ICAHT grading results"""
-    __tablename__ = 'patient_results'
-    
-    id = db.Column(db.Integer, primary_key=True)
-    job_id = db.Column(db.Integer, db.ForeignKey('processing_jobs.id'), nullable=False)
-    patient_id = db.Column(db.String(100), nullable=False)
-    
-    # Early ICAHT results
-    early_icaht_grade = db.Column(db.String(20))
-    duration_below_500_max = db.Column(db.Integer, default=0)
-    duration_below_100_max = db.Column(db.Integer, default=0)
-    grade_4_special = db.Column(db.Boolean, default=False)
-    exceedances_500 = db.Column(db.Integer, default=0)
-    exceedances_100 = db.Column(db.Integer, default=0)
-    
-    # Late ICAHT results
-    late_icaht_grade = db.Column(db.String(20))
-    anc_1 = db.Column(db.Float)  # Lowest ANC value
-    anc_2 = db.Column(db.Float)  # Second lowest ANC value
-    anc_count = db.Column(db.Integer, default=0)
-    
-    # Metadata
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    
-    def to_dict(self):
-        """Convert result to dictionary for JSON response"""
-        return {
-            'patient_id': self.patient_id,
-            'early_icaht_grade': self.early_icaht_grade,
-            'late_icaht_grade': self.late_icaht_grade,
-            'duration_below_500_max': self.duration_below_500_max,
-            'duration_below_100_max': self.duration_below_100_max,
-            'grade_4_special': self.grade_4_special,
-            'anc_1': self.anc_1,
-            'anc_2': self.anc_2,
-            'anc_count': self.anc_count
-        }
-    
-    def __repr__(self):
-        return f'<PatientResult {self.patient_id}: Early {self.early_icaht_grade}, Late {self.late_icaht_grade}>'
-
-class ProcessingAudit(db.Model):
-    """Audit trail for processing operations"""
-    __tablename__ = 'processing_audits'
-    
-    id = db.Column(db.Integer, primary_key=True)
-    job_id = db.Column(db.Integer, db.ForeignKey('processing_jobs.id'), nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
-    
-    action = db.Column(db.String(100), nullable=False)  # 'upload', 'validate', 'process', 'export', 'view'
-    details = db.Column(db.Text)  # JSON string with additional details
-    ip_address = db.Column(db.String(45))  # IPv4 or IPv6
-    user_agent = db.Column(db.String(255))
-    
-    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
-    
-    def set_details(self, details_dict):
-        """Store details as JSON string"""
-        self.details = json.dumps(details_dict)
-    
-    def get_details(self):
-        """Retrieve details from JSON string"""
-        if self.details:
-            return json.loads(self.details)
-        return {}
-    
-    def __repr__(self):
-        return f'<ProcessingAudit {self.action} by User {self.user_id}>'
-
-# Database utility functions
-def init_database(app):
-    """Initialize database with app context"""
-    with app.app_context():
-        db.create_all()
-        
-        # Create default admin user if none exists
-        admin_user = User.query.filter_by(role='admin').first()
-        if not admin_user:
-            admin = User(
-                username='admin',
-                email='admin@icaht.local',
-                role='admin'
-            )
-            admin.set_password('admin123')  # Change this in production!
-            db.session.add(admin)
-            db.session.commit()
-            print("Default admin user created: admin/admin123")
-
-def create_user(username, email, password, role='user'):
-    """Helper function to create a new user"""
-    # Check if user already exists
-    if User.query.filter((User.username == username) | (User.email == email)).first():
-        return None, "User with this username or email already exists"
-    
-    user = User(username=username, email=email, role=role)
-    user.set_password(password)
-    
-    try:
-        db.session.add(user)
-        db.session.commit()
-        return user, "User created successfully"
-    except Exception as e:
-        db.session.rollback()
-        return None, f"Error creating user: {str(e)}"
+    return redirect(url_for('auth.admin_users'))
@@ -1,7 +1,12 @@
 # config.py - Production-ready configuration
 import os
+import orjson
 from datetime import timedelta
 
+def json_dumps(obj):
+    """JSON column serializer; orjson also handles numpy values in audit details"""
+    return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+
 class Config:
     # Flask settings
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'dev-secret-key-change-in-production-immediately'
@@ -14,10 +19,41 @@ class Config:
         SQLALCHEMY_DATABASE_URI = SQLALCHEMY_DATABASE_URI.replace('postgres://', 'postgresql://', 1)
     
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'json_serializer': json_dumps,
+        'json_deserializer': orjson.loads
+    }
+    
+    # Background processing queue (RQ); jobs run inline when REDIS_URL is unset
+    REDIS_URL = os.environ.get('REDIS_URL')
+    PROCESSING_JOB_TIMEOUT = int(os.environ.get('PROCESSING_JOB_TIMEOUT', 1800))
+    
+    # Cache settings (user lookups); shared through Redis when available so a deactivated or
+    # demoted user is evicted on every worker. A per-process SimpleCache is only cleared on the
+    # worker that made the change, so others may serve the old user for up to its 5s timeout
+    CACHE_TYPE = os.environ.get('CACHE_TYPE') or ('RedisCache' if REDIS_URL else 'SimpleCache')
+    CACHE_REDIS_URL = REDIS_URL
+    CACHE_DEFAULT_TIMEOUT = 60 if CACHE_TYPE == 'RedisCache' else 5
+    
+    # Server-side sessions in Redis when available; signed cookie sessions otherwise
+    SESSION_TYPE = 'redis' if REDIS_URL else None
+    SESSION_USE_SIGNER = True
+    SESSION_PERMANENT = False
+    
+    # Login/register POSTs per client address and username; counters live in Redis when available
+    AUTH_RATE_LIMIT = os.environ.get('AUTH_RATE_LIMIT', '10/minute;100/hour')
+    RATELIMIT_STORAGE_URI = REDIS_URL or 'memory://'
+    RATELIMIT_SWALLOW_ERRORS = True  # a Redis outage shouldn't lock everyone out
+    
+    # Seconds the /health database ping may take before reporting unhealthy
+    HEALTH_CHECK_TIMEOUT = float(os.environ.get('HEALTH_CHECK_TIMEOUT', 0.5))
     
     # File upload settings
     UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'uploads')
     MAX_CONTENT_LENGTH = 50 * 1024 * 1024  # 50MB max file size
+    UPLOAD_BUFFER_SIZE = 1024 * 1024  # uploads beyond 1MB spill to a temp file in UPLOAD_FOLDER
+    # Parquet cache of graded results keyed by input hash; unset disables it (entries are never evicted)
+    GRADE_CACHE_FOLDER = os.environ.get('GRADE_CACHE_FOLDER')
     
     # ICAHT grading parameters
     EARLY_ICAHT_DAYS = int(os.environ.get('EARLY_ICAHT_DAYS', 30))
@@ -31,3 +67,21 @@ class Config:
     SESSION_COOKIE_SECURE = os.environ.get('FLASK_ENV') == 'production'
     SESSION_COOKIE_HTTPONLY = True
     SESSION_COOKIE_SAMESITE = 'Lax'
+    # Argon2id password hashing; aim for ~250ms per hash on production hardware
+    ARGON2_TIME_COST = int(os.environ.get('ARGON2_TIME_COST', 2))
+    ARGON2_MEMORY_COST = int(os.environ.get('ARGON2_MEMORY_COST', 65536))  # KiB
+    ARGON2_PARALLELISM = int(os.environ.get('ARGON2_PARALLELISM', 1))
+
+class TestConfig(Config):
+    """Configuration for the test suite - never use in production"""
+    TESTING = True
+    WTF_CSRF_ENABLED = False
+    # Store passwords as plain text so tests don't pay for Argon2id on every login/register.
+    # Hashes written this way are rejected under any other config.
+    PASSWORD_HASH_SCHEME = 'plaintext'
+    RATELIMIT_ENABLED = False
+
+config_by_name = {
+    'default': Config,
+    'testing': TestConfig
+}
@@ -1,40 +1,141 @@
 # models.py - Complete database models for authentication and persistence
+from flask import current_app
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
 from datetime import datetime
-from werkzeug.security import generate_password_hash, check_password_hash
-import json
+from werkzeug.security import check_password_hash
+import bcrypt
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
+import hmac
+import threading
+from collections import OrderedDict
+from sqlalchemy import inspect, text
+from sqlalchemy.dialects.postgresql import JSONB, insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 
 db = SQLAlchemy()
 
+# JSON document column: JSONB on PostgreSQL, JSON (text) elsewhere; None stays SQL NULL
+JSONDocument = db.JSON(none_as_null=True).with_variant(JSONB(none_as_null=True), 'postgresql')
+
+# INSERT constructs that support ON CONFLICT DO NOTHING, by dialect
+CONFLICT_INSERTS = {'postgresql': postgresql_insert, 'sqlite': sqlite_insert}
+
+# Marks hashes written by the test-only plaintext scheme (see TestConfig)
+PLAINTEXT_HASH_PREFIX = 'plain$'
+
+# Recently verified (hash, password) pairs, stored as HMACs so no plaintext is kept in memory
+VERIFIED_PASSWORD_CACHE_SIZE = 4096
+_verified_passwords = OrderedDict()
+_verified_passwords_lock = threading.Lock()
+
+def _verification_key(password_hash, password):
+    """HMAC the stored hash and candidate password with the app secret"""
+    pepper = current_app.config['SECRET_KEY'].encode('utf-8')
+    return (
+        hmac.new(pepper, password_hash.encode('utf-8'), 'sha256').digest(),
+        hmac.new(pepper, password.encode('utf-8'), 'sha256').digest()
+    )
+
+def password_hasher():
+    """Argon2id hasher with the configured cost parameters"""
+    return PasswordHasher(
+        time_cost=current_app.config['ARGON2_TIME_COST'],
+        memory_cost=current_app.config['ARGON2_MEMORY_COST'],
+        parallelism=current_app.config['ARGON2_PARALLELISM']
+    )
+
+def plaintext_passwords_enabled():
+    """Whether the app is configured for the test-only plaintext password scheme"""
+    return current_app.config.get('PASSWORD_HASH_SCHEME') == 'plaintext'
+
 class User(UserMixin, db.Model):
     """User model for authentication"""
     __tablename__ = 'users'
+    __table_args__ = (
+        # Login looks users up by username or email among active accounts
+        db.Index('ix_users_username_active', 'username',
+                 postgresql_where=db.text('is_active'), sqlite_where=db.text('is_active')),
+        db.Index('ix_users_email_active', 'email',
+                 postgresql_where=db.text('is_active'), sqlite_where=db.text('is_active')),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
     email = db.Column(db.String(120), unique=True, nullable=False)
     password_hash = db.Column(db.String(255), nullable=False)
     role = db.Column(db.String(20), default='user')  # 'user' or 'admin'
+    is_admin = db.Column(db.Boolean, nullable=False, default=False)  # derived from role
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     last_login = db.Column(db.DateTime)
     is_active = db.Column(db.Boolean, default=True)
     
     # Relationship to processing jobs
-    processing_jobs = db.relationship('ProcessingJob', backref='user', cascade='all, delete-orphan')
+    processing_jobs = db.relationship('ProcessingJob', back_populates='user', cascade='all, delete-orphan')
+    
+    @db.validates('role')
+    def _sync_is_admin(self, key, role):
+        """Keep the is_admin flag in step with role"""
+        self.is_admin = role == 'admin'
+        return role
     
     def set_password(self, password):
         """Hash and set password"""
-        self.password_hash = generate_password_hash(password)
+        if plaintext_passwords_enabled():
+            self.password_hash = PLAINTEXT_HASH_PREFIX + password
+            return
+        self.password_hash = password_hasher().hash(password)
     
     def check_password(self, password):
-        """Check if provided password matches hash"""
+        """Check if provided password matches hash, skipping the KDF for recently verified pairs"""
+        # The key covers the hash itself, so set_password invalidates old entries
+        key = _verification_key(self.password_hash, password)
+        with _verified_passwords_lock:
+            if key in _verified_passwords:
+                _verified_passwords.move_to_end(key)
+                return True
+        
+        # Only successes are cached, so failed guesses can't flush the cache
+        if not self._verify_password(password):
+            return False
+        
+        with _verified_passwords_lock:
+            _verified_passwords[key] = True
+            if len(_verified_passwords) > VERIFIED_PASSWORD_CACHE_SIZE:
+                _verified_passwords.popitem(last=False)
+        return True
+    
+    def _verify_password(self, password):
+        """Run the password check for whichever scheme produced the stored hash"""
+        if self.password_hash.startswith(PLAINTEXT_HASH_PREFIX):
+            # Only honoured while the plaintext scheme is configured
+            return plaintext_passwords_enabled() and hmac.compare_digest(
+                self.password_hash.encode('utf-8'),
+                (PLAINTEXT_HASH_PREFIX + password).encode('utf-8')
+            )
+        if self.password_hash.startswith('$argon2'):
+            try:
+                return password_hasher().verify(self.password_hash, password)
+            except (VerificationError, InvalidHashError):
+                return False
+        if self.password_hash.startswith('$2'):
+            # Legacy bcrypt hash, upgraded on next login
+            return bcrypt.checkpw(password.encode('utf-8'), self.password_hash.encode('utf-8'))
+        # Legacy werkzeug pbkdf2 hash from before bcrypt
         return check_password_hash(self.password_hash, password)
     
+    def needs_rehash(self):
+        """Whether the stored hash is a legacy scheme or uses outdated Argon2 parameters"""
+        if self.password_hash.startswith(PLAINTEXT_HASH_PREFIX):
+            return False
+        if self.password_hash.startswith('$argon2'):
+            return password_hasher().check_needs_rehash(self.password_hash)
+        return True
+    
     def update_last_login(self):
-        """Update last login timestamp"""
+        """Update last login timestamp; the caller commits"""
         self.last_login = datetime.utcnow()
-        db.session.commit()
     
     def __repr__(self):
         return f'<User {self.username}>'
@@ -42,6 +143,10 @@ class User(UserMixin, db.Model):
 class ProcessingJob(db.Model):
     """Track processing jobs and their results"""
     __tablename__ = 'processing_jobs'
+    __table_args__ = (
+        db.Index('ix_job_user_hash', 'user_id', 'file_hash'),  # duplicate upload check
+        db.Index('ix_job_user_created', 'user_id', 'created_at'),  # job history and profile listings (scanned backwards for DESC)
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
@@ -59,8 +164,8 @@ class ProcessingJob(db.Model):
     # Error handling
     error_message = db.Column(db.Text)
     
-    # Processing settings (stored as JSON)
-    settings = db.Column(db.Text)
+    # Processing settings
+    settings = db.Column(JSONDocument)
     
     # Results summary
     total_patients = db.Column(db.Integer, default=0)
@@ -68,21 +173,21 @@ class ProcessingJob(db.Model):
     
     # File information
     file_size = db.Column(db.Integer)  # in bytes
-    file_hash = db.Column(db.String(64))  # for duplicate detection
+    file_hash = db.Column(db.LargeBinary(16))  # raw BLAKE2b digest, for duplicate detection
+    stored_path = db.Column(db.String(512))  # location of the upload on disk
     
-    # Relationships
-    results = db.relationship('PatientResult', backref='job', cascade='all, delete-orphan')
-    audit_logs = db.relationship('ProcessingAudit', backref='job', cascade='all, delete-orphan')
+    # Relationships - the many-to-one sides raise on access; code uses the *_id columns
+    user = db.relationship('User', back_populates='processing_jobs', lazy='raise')
+    results = db.relationship('PatientResult', back_populates='job', cascade='all, delete-orphan')
+    audit_logs = db.relationship('ProcessingAudit', back_populates='job', cascade='all, delete-orphan')
     
     def set_settings(self, settings_dict):
-        """Store settings as JSON string"""
-        self.settings = json.dumps(settings_dict)
+        """Store settings"""
+        self.settings = settings_dict
     
     def get_settings(self):
-        """Retrieve settings from JSON string"""
-        if self.settings:
-            return json.loads(self.settings)
-        return {}
+        """Retrieve settings"""
+        return self.settings or {}
     
     def get_duration(self):
         """Calculate processing duration"""
@@ -96,10 +201,14 @@ class ProcessingJob(db.Model):
 class PatientResult(db.Model):
     """Store individual patient ICAHT grading results"""
     __tablename__ = 'patient_results'
+    __table_args__ = (
+        db.Index('ix_patient_job', 'job_id'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     job_id = db.Column(db.Integer, db.ForeignKey('processing_jobs.id'), nullable=False)
     patient_id = db.Column(db.String(100), nullable=False)
+    job = db.relationship('ProcessingJob', back_populates='results', lazy='raise')
     
     # Early ICAHT results
     early_icaht_grade = db.Column(db.String(20))
@@ -142,35 +251,66 @@ class ProcessingAudit(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     job_id = db.Column(db.Integer, db.ForeignKey('processing_jobs.id'), nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    job = db.relationship('ProcessingJob', back_populates='audit_logs', lazy='raise')
     
     action = db.Column(db.String(100), nullable=False)  # 'upload', 'validate', 'process', 'export', 'view'
-    details = db.Column(db.Text)  # JSON string with additional details
+    details = db.Column(JSONDocument)  # additional details
     ip_address = db.Column(db.String(45))  # IPv4 or IPv6
     user_agent = db.Column(db.String(255))
     
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     
     def set_details(self, details_dict):
-        """Store details as JSON string"""
-        self.details = json.dumps(details_dict)
+        """Store details"""
+        self.details = details_dict
     
     def get_details(self):
-        """Retrieve details from JSON string"""
-        if self.details:
-            return json.loads(self.details)
-        return {}
+        """Retrieve details"""
+        return self.details or {}
     
     def __repr__(self):
         return f'<ProcessingAudit {self.action} by User {self.user_id}>'
 
 # Database utility functions
+def migrate_schema():
+    """Bring tables created by older versions up to date; create_all never alters existing tables"""
+    inspector = inspect(db.engine)
+    user_columns = {col['name'] for col in inspector.get_columns('users')}
+    job_columns = {col['name']: col['type'] for col in inspector.get_columns('processing_jobs')}
+    
+    with db.engine.begin() as conn:
+        if 'is_admin' not in user_columns:
+            conn.execute(text('ALTER TABLE users ADD COLUMN is_admin BOOLEAN NOT NULL DEFAULT FALSE'))
+            conn.execute(text("UPDATE users SET is_admin = COALESCE(role = 'admin', FALSE)"))
+        
+        # Older jobs can't be matched to their uploads, so their stored_path stays NULL
+        if 'stored_path' not in job_columns:
+            conn.execute(text('ALTER TABLE processing_jobs ADD COLUMN stored_path VARCHAR(512)'))
+        
+        # file_hash used to hold hex text; it now holds the raw digest
+        if conn.dialect.name == 'postgresql':
+            if not isinstance(job_columns['file_hash'], db.LargeBinary):
+                conn.execute(text(
+                    "ALTER TABLE processing_jobs ALTER COLUMN file_hash TYPE bytea USING decode(file_hash, 'hex')"
+                ))
+        else:
+            hex_hashes = conn.execute(text(
+                "SELECT id, file_hash FROM processing_jobs WHERE typeof(file_hash) = 'text'"
+            )).all()
+            if hex_hashes:
+                conn.execute(
+                    text('UPDATE processing_jobs SET file_hash = :digest WHERE id = :id'),
+                    [{'id': job_id, 'digest': bytes.fromhex(value)} for job_id, value in hex_hashes]
+                )
+
 def init_database(app):
     """Initialize database with app context"""
     with app.app_context():
         db.create_all()
+        migrate_schema()
         
         # Create default admin user if none exists
-        admin_user = User.query.filter_by(role='admin').first()
+        admin_user = User.query.filter_by(is_admin=True).first()
         if not admin_user:
             admin = User(
                 username='admin',
@@ -184,17 +324,23 @@ def init_database(app):
 
 def create_user(username, email, password, role='user'):
     """Helper function to create a new user"""
-    # Check if user already exists
-    if User.query.filter((User.username == username) | (User.email == email)).first():
-        return None, "User with this username or email already exists"
-    
     user = User(username=username, email=email, role=role)
     user.set_password(password)
     
+    # Let the unique constraints arbitrate: a duplicate username or email inserts nothing
+    insert = CONFLICT_INSERTS[db.engine.dialect.name]
+    stmt = insert(User).values(
+        username=username, email=email, role=role, is_admin=user.is_admin,
+        password_hash=user.password_hash
+    ).on_conflict_do_nothing()
+    
     try:
-        db.session.add(user)
+        result = db.session.execute(stmt)
+        if result.rowcount == 0:
+            db.session.rollback()
+            return None, "User with this username or email already exists"
         db.session.commit()
-        return user, "User created successfully"
+        return db.session.get(User, result.inserted_primary_key[0]), "User created successfully"
     except Exception as e:
         db.session.rollback()
         return None, f"Error creating user: {str(e)}"
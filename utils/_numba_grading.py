@@ -0,0 +1,72 @@
+import numpy as np
+from numba import njit, prange
+
+@njit(cache=True)
+def _exceedance_stats(anc, days, threshold, recovery_days):
+    """Scan one patient's ANC series for joined periods below threshold"""
+    max_duration = 0
+    count = 0
+    run_start = -1
+    run_end = -1
+    last_day = -1
+    in_run = False
+
+    for i in range(anc.shape[0]):
+        # Missing values neither start nor end an exceedance
+        if np.isnan(anc[i]):
+            continue
+
+        last_day = days[i]
+        if anc[i] < threshold:
+            if not in_run:
+                if count > 0 and days[i] - run_end - 1 <= recovery_days - 1:
+                    # Recovery too short - join with the previous exceedance
+                    pass
+                else:
+                    if count > 0:
+                        max_duration = max(max_duration, run_end - run_start + 1)
+                    count += 1
+                    run_start = days[i]
+                in_run = True
+            run_end = days[i]
+        else:
+            in_run = False
+
+    if count > 0:
+        max_duration = max(max_duration, run_end - run_start + 1)
+
+    return max_duration, count, run_start, run_end, last_day
+
+@njit(cache=True, parallel=True)
+def early_exceedance_stats(offsets, anc, days, threshold_500, threshold_100, recovery_days):
+    """Per-patient exceedance durations, counts and grade 4 special flag
+
+    Rows must be grouped by patient and sorted by day within each patient;
+    patient p owns rows offsets[p]:offsets[p + 1].
+    """
+    n_patients = offsets.shape[0] - 1
+    duration_500 = np.zeros(n_patients, np.int64)
+    duration_100 = np.zeros(n_patients, np.int64)
+    count_500 = np.zeros(n_patients, np.int64)
+    count_100 = np.zeros(n_patients, np.int64)
+    grade_4_special = np.zeros(n_patients, np.bool_)
+
+    for p in prange(n_patients):
+        lo = offsets[p]
+        hi = offsets[p + 1]
+
+        d500, n500, start, end, last_day = _exceedance_stats(
+            anc[lo:hi], days[lo:hi], threshold_500, recovery_days
+        )
+        d100, n100, _, _, _ = _exceedance_stats(
+            anc[lo:hi], days[lo:hi], threshold_100, recovery_days
+        )
+
+        duration_500[p] = d500
+        duration_100[p] = d100
+        count_500[p] = n500
+        count_100[p] = n100
+        # Only the final exceedance can reach the last day with ANC data
+        grade_4_special[p] = n500 > 0 and start <= 3 and end == last_day
+
+    return duration_500, duration_100, count_500, count_100, grade_4_special
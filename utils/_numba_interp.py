@@ -0,0 +1,44 @@
+import numpy as np
+from numba import njit, prange
+
+@njit(cache=True, parallel=True)
+def interpolate_anc(offsets, anc, limit):
+    """Per-patient linear interpolation of missing ANC values
+
+    Matches Series.interpolate(method='linear', limit=limit, limit_direction='both'):
+    a missing value is filled when it is within limit rows of a valid value on
+    either side, and values before the first / after the last valid sample are
+    held constant. Rows must be grouped by patient and sorted by day within
+    each patient; patient p owns rows offsets[p]:offsets[p + 1].
+    """
+    out = anc.copy()
+
+    for p in prange(offsets.shape[0] - 1):
+        lo = offsets[p]
+        hi = offsets[p + 1]
+        prev = -1  # last valid row seen, -1 before the first
+
+        # Each valid row (and the end of the patient) closes the gap after prev
+        for i in range(lo, hi + 1):
+            if i < hi and np.isnan(anc[i]):
+                continue
+
+            has_prev = prev >= 0
+            has_next = i < hi
+            slope = 0.0
+            if has_prev and has_next:
+                slope = (anc[i] - anc[prev]) / (i - prev)
+
+            for k in range(prev + 1 if has_prev else lo, i):
+                if not ((has_prev and k - prev <= limit) or (has_next and i - k <= limit)):
+                    continue
+                if not has_prev:
+                    out[k] = anc[i]
+                elif not has_next:
+                    out[k] = anc[prev]
+                else:
+                    out[k] = slope * (k - prev) + anc[prev]
+
+            prev = i
+
+    return out
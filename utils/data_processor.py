@@ -1,174 +1,54 @@
+import os
 import pandas as pd
 import numpy as np
+import numexpr as ne
 from datetime import datetime, timedelta
-from scipy import interpolate
 
-class DataProcessor:
-    def __init__(self):
-        self.required_columns = [
-            'patient_id', 'cart_date', 'date', 'anc', 
-            'last_fu_date', 'subsequent_therapy_date', 'progression_date'
-        ]
-    
-    def prepare_data(self, df, settings=None):
-        """Prepare data for ICAHT grading"""
-        if settings is None:
-            settings = {}
-        
-        # Validate required columns
-        missing_cols = [col for col in self.required_columns if col not in df.columns]
-        if missing_cols:
-            raise ValueError(f"Missing required columns: {missing_cols}")
-        
-        # Convert date columns
-        date_columns = ['cart_date', 'date', 'last_fu_date', 'subsequent_therapy_date', 'progression_date']
-        for col in date_columns:
-            if col in df.columns:
-                df[col] = pd.to_datetime(df[col], errors='coerce')
-        
-        # Clean ANC values
-        df['anc'] = pd.to_numeric(df['anc'], errors='coerce')
-        
-        # Prepare early ICAHT data (days 0-30)
-        early_data = self._prepare_early_data(df, settings)
-        
-        # Prepare late ICAHT data (days 31+)
-        late_data = self._prepare_late_data(df, settings)
-        
-        return {
-            'early': early_data,
-            'late': late_data,
-            'original': df
-        }
-    
-    def _prepare_early_data(self, df, settings):
-        """Prepare data for early ICAHT grading (days 0-30)"""
-        max_days = settings.get('early_days', 30)
-        
-        # Calculate days post-infusion
-        df_early = df.copy()
-        df_early['time_post_inf'] = (df_early['date'] - df_early['cart_date']).dt.days
-        
-        # Filter to early period
-        df_early = df_early[
-            (df_early['time_post_inf'] >= 0) & 
-            (df_early['time_post_inf'] <= max_days)
-        ].copy()
-        
-        # Handle multiple ANC values per day (keep lowest)
-        df_early = df_early.groupby(['patient_id', 'time_post_inf']).agg({
-            'cart_date': 'first',
-            'date': 'first',
-            'anc': 'min',
-            'last_fu_date': 'first'
-        }).reset_index()
-        
-        # Create complete time series for each patient
-        df_early = self._create_complete_timeseries(df_early, max_days)
-        
-        # Interpolate missing ANC values
-        df_early = self._interpolate_anc_values(df_early, settings)
-        
-        return df_early
+try:
+    from utils._numba_interp import interpolate_anc
+except ImportError:  # numba not installed - interpolate with vectorized NumPy
+    interpolate_anc = None
+
+ne.set_num_threads(os.cpu_count() or 1)
+
+NS_PER_DAY = 86_400_000_000_000
+
+def days_between(later, earlier, missing):
+    """Whole days from earlier to later, floored like Timedelta.days; missing where either is NaT"""
+    later = later.to_numpy(dtype='datetime64[ns]')
+    earlier = earlier.to_numpy(dtype='datetime64[ns]')
+    days = (later.view('i8') - earlier.view('i8')) // NS_PER_DAY
+    days[np.isnat(later) | np.isnat(earlier)] = missing
+    return days
+
+def interpolate_anc_numpy(offsets, anc, limit):
+    """Vectorized NumPy version of the numba interpolate_anc kernel, with the same inputs and results"""
+    pos = np.arange(anc.shape[0])
+    valid = ~np.isnan(anc)
+    if not valid.any():
+        return anc.copy()
     
-    def _prepare_late_data(self, df, settings):
-        """Prepare data for late ICAHT grading (days 31+)"""
-        # Calculate days post-infusion
-        df_late = df.copy()
-        df_late['time_post_inf'] = (df_late['date'] - df_late['cart_date']).dt.days
-        
-        # Calculate end date for late period
-        df_late['end_date'] = df_late[['cart_date', 'subsequent_therapy_date', 
-                                      'progression_date', 'last_fu_date']].min(axis=1)
-        df_late['end_date'] = df_late['end_date'].fillna(df_late['cart_date'] + timedelta(days=100))
-        
-        # Filter to late period
-        df_late = df_late[
-            (df_late['time_post_inf'] >= 31) & 
-            (df_late['date'] <= df_late['end_date'])
-        ].copy()
-        
-        # Handle multiple ANC values per day (keep lowest)
-        df_late = df_late.groupby(['patient_id', 'time_post_inf']).agg({
-            'cart_date': 'first',
-            'date': 'first',
-            'anc': 'min',
-            'end_date': 'first'
-        }).reset_index()
-        
-        return df_late
+    # Each row's patient bounds, and the nearest valid rows at or before / after it
+    counts = np.diff(offsets)
+    lo = np.repeat(offsets[:-1], counts)
+    hi = np.repeat(offsets[1:], counts)
+    prev = np.maximum.accumulate(np.where(valid, pos, -1))
+    after = np.minimum.accumulate(np.where(valid, pos, anc.shape[0])[::-1])[::-1]
+    has_prev = prev >= lo
+    has_next = after < hi
     
-    def _create_complete_timeseries(self, df, max_days):
-        """Create complete time series with missing days"""
-        complete_data = []
-        
-        for patient_id in df['patient_id'].unique():
-            patient_data = df[df['patient_id'] == patient_id].copy()
-            
-            # Get patient info
-            cart_date = patient_data['cart_date'].iloc[0]
-            last_fu_date = patient_data['last_fu_date'].iloc[0]
-            
-            # Determine follow-up period
-            if pd.isna(last_fu_date):
-                follow_up_days = max_days
-            else:
-                follow_up_days = min(max_days, (last_fu_date - cart_date).days)
-            
-            # Create complete date range
-            for day in range(follow_up_days + 1):
-                date = cart_date + timedelta(days=day)
-                
-                # Check if we have data for this day
-                day_data = patient_data[patient_data['time_post_inf'] == day]
-                
-                if len(day_data) > 0:
-                    # Use existing data
-                    complete_data.append(day_data.iloc[0].to_dict())
-                else:
-                    # Create missing day entry
-                    complete_data.append({
-                        'patient_id': patient_id,
-                        'cart_date': cart_date,
-                        'date': date,
-                        'time_post_inf': day,
-                        'anc': np.nan,
-                        'last_fu_date': last_fu_date
-                    })
-        
-        return pd.DataFrame(complete_data)
+    # One np.interp over all patients is right wherever both neighbours belong to the row's
+    # patient; past a patient's first / last sample the value is held constant instead
+    out = np.interp(pos, pos[valid], anc[valid])
+    out = np.where(has_next, out, anc[prev])
+    out = np.where(has_prev, out, anc[np.minimum(after, anc.shape[0] - 1)])
     
-    def _interpolate_anc_values(self, df, settings):
-        """Interpolate missing ANC values using linear interpolation"""
-        max_gap = settings.get('max_gap_days', 7)
-        
-        interpolated_data = []
-        
-        for patient_id in df['patient_id'].unique():
-            patient_data = df[df['patient_id'] == patient_id].copy().sort_values('time_post_inf')
-            
-            # Interpolate missing values
-            patient_data['anc_interpolated'] = patient_data['anc'].interpolate(
-                method='linear', 
-                limit=max_gap,
-                limit_direction='both'
-            )
-            
-            # Round to nearest 10 (to resemble real ANC values)
-            patient_data['anc_interpolated'] = (
-                patient_data['anc_interpolated'].round(-1)
-            ).astype('Int64')  # Use nullable integer type
-            
-            # Use interpolated values where original is missing
-            patient_data['anc_final'] = patient_data['anc'].fillna(patient_data['anc_interpolated'])
-            
-            interpolated_data.append(patient_data)
-        
-import numpy as np
-from datetime import datetime, timedelta
-from scipy import interpolate
+    fill = (has_prev & (pos - prev <= limit)) | (has_next & (after - pos <= limit))
+    return np.where(valid, anc, np.where(fill, out, np.nan))
 
 class DataProcessor:
+    __slots__ = ('required_columns',)
+    
     def __init__(self):
         self.required_columns = [
             'patient_id', 'cart_date', 'date', 'anc', 
@@ -187,18 +67,43 @@ class DataProcessor:
         
         # Convert date columns
         date_columns = ['cart_date', 'date', 'last_fu_date', 'subsequent_therapy_date', 'progression_date']
-        for col in date_columns:
-            if col in df.columns:
-                df[col] = pd.to_datetime(df[col], errors='coerce')
-        
-        # Clean ANC values
-        df['anc'] = pd.to_numeric(df['anc'], errors='coerce')
+        # Columns that are already datetime64 (from the reader or parquet) are left alone
+        pending = [col for col in date_columns if col in df.columns and df[col].dtype.kind != 'M']
+        if pending:
+            df[pending] = df[pending].apply(pd.to_datetime, errors='coerce')
+        
+        # Clean ANC values; plain float64 with NaN for missing, no nullable masks. The late
+        # nadirs are stored from this column, so it keeps the sheet's values exactly
+        df['anc'] = pd.to_numeric(df['anc'], errors='coerce').astype(np.float64)
+        
+        # Factorize patient IDs once; the groupbys, sorts and reindex below then work on integer codes
+        df['patient_id'] = df['patient_id'].astype('category')
+        
+        # Days post-infusion, computed once for both periods; rows missing either date
+        # get a day that neither period accepts
+        df['time_post_inf'] = days_between(
+            df['date'], df['cart_date'], np.iinfo(np.int32).min
+        ).astype(np.int32)
+        
+        # The conversions above each left a separate block; consolidate once so the groupby
+        # reads one contiguous block per dtype
+        df = df.copy()
+        
+        # Handle multiple ANC values per day (keep lowest), once for both periods
+        daily = df.groupby(['patient_id', 'time_post_inf'], observed=True).agg(
+            cart_date=('cart_date', 'first'),
+            date=('date', 'first'),
+            anc=('anc', 'min'),
+            last_fu_date=('last_fu_date', 'first'),
+            subsequent_therapy_date=('subsequent_therapy_date', 'first'),
+            progression_date=('progression_date', 'first')
+        ).reset_index()
         
         # Prepare early ICAHT data (days 0-30)
-        early_data = self._prepare_early_data(df, settings)
+        early_data = self._prepare_early_data(daily, settings)
         
         # Prepare late ICAHT data (days 31+)
-        late_data = self._prepare_late_data(df, settings)
+        late_data = self._prepare_late_data(daily, settings)
         
         return {
             'early': early_data,
@@ -210,23 +115,12 @@ class DataProcessor:
         """Prepare data for early ICAHT grading (days 0-30)"""
         max_days = settings.get('early_days', 30)
         
-        # Calculate days post-infusion
-        df_early = df.copy()
-        df_early['time_post_inf'] = (df_early['date'] - df_early['cart_date']).dt.days
-        
-        # Filter to early period
-        df_early = df_early[
-            (df_early['time_post_inf'] >= 0) & 
-            (df_early['time_post_inf'] <= max_days)
-        ].copy()
-        
-        # Handle multiple ANC values per day (keep lowest)
-        df_early = df_early.groupby(['patient_id', 'time_post_inf']).agg({
-            'cart_date': 'first',
-            'date': 'first',
-            'anc': 'min',
-            'last_fu_date': 'first'
-        }).reset_index()
+        # Filter to early period, copying only the kept days and the columns used below
+        day = df['time_post_inf'].to_numpy()
+        keep = ne.evaluate('(day >= 0) & (day <= max_days)')
+        # Early ANC only feeds the grading kernels, which work in float32
+        df_early = df.loc[keep, ['patient_id', 'time_post_inf', 'cart_date', 'date', 'anc', 'last_fu_date']]
+        df_early = df_early.astype({'anc': np.float32})
         
         # Create complete time series for each patient
         df_early = self._create_complete_timeseries(df_early, max_days)
@@ -238,95 +132,68 @@ class DataProcessor:
     
     def _prepare_late_data(self, df, settings):
         """Prepare data for late ICAHT grading (days 31+)"""
-        # Calculate days post-infusion
-        df_late = df.copy()
-        df_late['time_post_inf'] = (df_late['date'] - df_late['cart_date']).dt.days
-        
-        # Calculate end date for late period
-        df_late['end_date'] = df_late[['cart_date', 'subsequent_therapy_date', 
-                                      'progression_date', 'last_fu_date']].min(axis=1)
-        df_late['end_date'] = df_late['end_date'].fillna(df_late['cart_date'] + timedelta(days=100))
-        
-        # Filter to late period
-        df_late = df_late[
-            (df_late['time_post_inf'] >= 31) & 
-            (df_late['date'] <= df_late['end_date'])
-        ].copy()
-        
-        # Handle multiple ANC values per day (keep lowest)
-        df_late = df_late.groupby(['patient_id', 'time_post_inf']).agg({
-            'cart_date': 'first',
-            'date': 'first',
-            'anc': 'min',
-            'end_date': 'first'
-        }).reset_index()
+        # Calculate end date for late period: earliest of these dates, skipping NaT
+        end_columns = ['cart_date', 'subsequent_therapy_date', 'progression_date', 'last_fu_date']
+        stamps = np.stack([df[col].to_numpy(dtype='datetime64[ns]').view('i8') for col in end_columns])
+        nat, latest = np.iinfo(np.int64).min, np.iinfo(np.int64).max
+        stamps[stamps == nat] = latest
+        end_date = np.minimum.reduce(stamps)
+        end_date[end_date == latest] = nat
+        end_date = pd.Series(end_date.view('datetime64[ns]'), index=df.index)
+        end_date = end_date.fillna(df['cart_date'] + timedelta(days=100))
+        
+        # Filter to late period, copying only the kept days and the columns used below
+        keep = ((df['time_post_inf'] >= 31) & (df['date'] <= end_date)).to_numpy()
+        df_late = df.loc[keep, ['patient_id', 'time_post_inf', 'cart_date', 'date', 'anc']].assign(
+            end_date=end_date.to_numpy()[keep]
+        ).reset_index(drop=True)
         
         return df_late
     
     def _create_complete_timeseries(self, df, max_days):
         """Create complete time series with missing days"""
-        complete_data = []
-        
-        for patient_id in df['patient_id'].unique():
-            patient_data = df[df['patient_id'] == patient_id].copy()
-            
-            # Get patient info
-            cart_date = patient_data['cart_date'].iloc[0]
-            last_fu_date = patient_data['last_fu_date'].iloc[0]
-            
-            # Determine follow-up period
-            if pd.isna(last_fu_date):
-                follow_up_days = max_days
-            else:
-                follow_up_days = min(max_days, (last_fu_date - cart_date).days)
-            
-            # Create complete date range
-            for day in range(follow_up_days + 1):
-                date = cart_date + timedelta(days=day)
-                
-                # Check if we have data for this day
-                day_data = patient_data[patient_data['time_post_inf'] == day]
-                
-                if len(day_data) > 0:
-                    # Use existing data
-                    complete_data.append(day_data.iloc[0].to_dict())
-                else:
-                    # Create missing day entry
-                    complete_data.append({
-                        'patient_id': patient_id,
-                        'cart_date': cart_date,
-                        'date': date,
-                        'time_post_inf': day,
-                        'anc': np.nan,
-                        'last_fu_date': last_fu_date
-                    })
-        
-        return pd.DataFrame(complete_data)
+        # Each patient's first row supplies the dates for the days we fill in
+        patients = df.drop_duplicates('patient_id')
+        follow_up_days = days_between(patients['last_fu_date'], patients['cart_date'], max_days)
+        day_counts = np.maximum(np.minimum(follow_up_days, max_days) + 1, 0)
+        
+        # Every (patient, day) pair from infusion to the end of follow-up
+        patient_ids = pd.Categorical.from_codes(
+            np.repeat(patients['patient_id'].cat.codes.to_numpy(), day_counts),
+            dtype=df['patient_id'].dtype
+        )
+        days = np.arange(day_counts.sum()) - np.repeat(np.cumsum(day_counts) - day_counts, day_counts)
+        days = days.astype(np.int32)
+        full_index = pd.MultiIndex.from_arrays([patient_ids, days], names=['patient_id', 'time_post_inf'])
+        
+        indexed = df.set_index(['patient_id', 'time_post_inf'])
+        missing = ~full_index.isin(indexed.index)
+        complete = indexed.reindex(full_index).reset_index()
+        
+        # Create missing day entries
+        cart_dates = np.repeat(patients['cart_date'].to_numpy(), day_counts)[missing]
+        complete.loc[missing, 'cart_date'] = cart_dates
+        complete.loc[missing, 'date'] = cart_dates + days[missing].astype('timedelta64[D]')
+        complete.loc[missing, 'last_fu_date'] = np.repeat(patients['last_fu_date'].to_numpy(), day_counts)[missing]
+        
+        return complete
     
     def _interpolate_anc_values(self, df, settings):
         """Interpolate missing ANC values using linear interpolation"""
         max_gap = settings.get('max_gap_days', 7)
         
-        interpolated_data = []
+        df = df.sort_values(['patient_id', 'time_post_inf'], kind='stable', ignore_index=True)
+        
+        # Interpolate missing values within each patient; patient p owns rows offsets[p]:offsets[p + 1]
+        codes, patient_ids = pd.factorize(df['patient_id'])
+        offsets = np.searchsorted(codes, np.arange(len(patient_ids) + 1))
+        interpolate = interpolate_anc if interpolate_anc is not None else interpolate_anc_numpy
+        df['anc_interpolated'] = interpolate(offsets, df['anc'].to_numpy(dtype=np.float64), max_gap)
+        
+        # Round to nearest 10 (to resemble real ANC values)
+        df['anc_interpolated'] = np.rint(df['anc_interpolated'].to_numpy() / 10.0).astype(np.float32) * 10
         
-        for patient_id in df['patient_id'].unique():
-            patient_data = df[df['patient_id'] == patient_id].copy().sort_values('time_post_inf')
-            
-            # Interpolate missing values
-            patient_data['anc_interpolated'] = patient_data['anc'].interpolate(
-                method='linear', 
-                limit=max_gap,
-                limit_direction='both'
-            )
-            
-            # Round to nearest 10 (to resemble real ANC values)
-            patient_data['anc_interpolated'] = (
-                patient_data['anc_interpolated'].round(-1)
-            ).astype('Int64')  # Use nullable integer type
-            
-            # Use interpolated values where original is missing
-            patient_data['anc_final'] = patient_data['anc'].fillna(patient_data['anc_interpolated'])
-            
-            interpolated_data.append(patient_data)
+        # Use interpolated values where original is missing
+        df['anc_final'] = df['anc'].fillna(df['anc_interpolated'])
         
-        return pd.concat(interpolated_data, ignore_index=True)
+        return df
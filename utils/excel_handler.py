@@ -1,7 +1,73 @@
 import pandas as pd
 import numpy as np
-from datetime import datetime
+from datetime import date, datetime, timedelta
+from collections import Counter
+from functools import lru_cache
+from itertools import chain, islice
+from operator import itemgetter
 import os
+import xlsxwriter
+from pandas.io.parsers import TextParser
+
+try:
+    from python_calamine import CalamineWorkbook
+except ImportError:  # python-calamine not installed - read with pandas' openpyxl engine
+    CalamineWorkbook = None
+
+# Export styles
+RESULTS_HEADER_FORMAT = {'bold': True, 'font_color': '#FFFFFF', 'bg_color': '#366092',
+                         'border': 1, 'align': 'center'}
+SUMMARY_HEADER_FORMAT = {'bold': True, 'border': 1, 'align': 'center'}
+GRADE_COLORS = {
+    'Grade 0': '#D4F4DD',
+    'Grade 1': '#FFF2CC',
+    'Grade 2': '#FFE699',
+    'Grade 3': '#FFCC99',
+    'Grade 4': '#FFB3B3'
+}
+
+# Non-null values checked when deciding whether a column holds dates / numbers at all
+VALIDATION_SAMPLE_SIZE = 32
+
+def write_float(worksheet, row, col, value, cell_format=None):
+    """xlsxwriter handler for floats: NaN (no late nadir) becomes a blank cell"""
+    if value != value:
+        return worksheet.write_blank(row, col, None, cell_format)
+    return None  # fall through to write_number
+
+def column_converts(series, kinds, convert):
+    """Whether a column already has a dtype of the given kinds, or a sample of it converts"""
+    if series.dtype.kind in kinds:
+        return True
+    sample = series.dropna().head(VALIDATION_SAMPLE_SIZE)
+    return sample.empty or convert(sample).notna().any()
+
+def convert_calamine_cell(value):
+    """Convert a calamine cell value the way pandas' Excel readers do"""
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, date):
+        return pd.Timestamp(value)
+    if isinstance(value, timedelta):
+        return pd.Timedelta(value)
+    return value
+
+def parse_sheet(path):
+    """Parse the first worksheet of a file"""
+    if CalamineWorkbook is None:
+        return pd.read_excel(path)
+    
+    rows = CalamineWorkbook.from_path(path).get_sheet_by_index(0).to_python()
+    if not rows:
+        return pd.DataFrame()
+    # Same header/NA/type inference read_excel applies to the cells it reads
+    data = [[convert_calamine_cell(cell) for cell in row] for row in rows]
+    return TextParser(data, header=0, skip_blank_lines=False).read()
+
+@lru_cache(maxsize=8)
+def parse_sheet_cached(path, mtime_ns, size):
+    """parse_sheet memoized per path, modification time and size"""
+    return parse_sheet(path)
 
 class ExcelHandler:
     def __init__(self):
@@ -10,12 +76,41 @@ class ExcelHandler:
             'last_fu_date', 'subsequent_therapy_date', 'progression_date'
         ]
     
+    def read_sheet(self, filepath, cached=False):
+        """Read the first worksheet into a DataFrame, via the Rust calamine parser when available"""
+        # Only files read again and again (the sample data) are worth caching; uploads are
+        # read once, so keeping their parses would just pin memory
+        if not cached:
+            return parse_sheet(filepath)
+        
+        # A rewritten file changes mtime or size and misses the cache; callers get a copy
+        # because clean_data converts columns in place
+        stat = os.stat(filepath)
+        return parse_sheet_cached(os.path.abspath(filepath), stat.st_mtime_ns, stat.st_size).copy()
+    
+    def load_and_validate(self, filepath):
+        """Read the file once; return (cleaned DataFrame or None, validation result)"""
+        try:
+            df = self.read_sheet(filepath)
+        except Exception as e:
+            return None, {'valid': False, 'message': f'File reading error: {str(e)}'}
+        
+        validation = self.validate_data(df)
+        if not validation['valid']:
+            return None, validation
+        return self.clean_data(df), validation
+    
     def validate_file(self, filepath):
         """Validate uploaded Excel file structure"""
         try:
-            # Try to read the file
-            df = pd.read_excel(filepath)
-            
+            df = self.read_sheet(filepath)
+        except Exception as e:
+            return {'valid': False, 'message': f'File reading error: {str(e)}'}
+        return self.validate_data(df)
+    
+    def validate_data(self, df):
+        """Validate the structure of a sheet read by read_sheet"""
+        try:
             if len(df) == 0:
                 return {'valid': False, 'message': 'File is empty'}
             
@@ -31,18 +126,14 @@ class ExcelHandler:
             if df['patient_id'].isna().all():
                 return {'valid': False, 'message': 'No valid patient IDs found'}
             
-            # Check for date columns
+            # Check for date columns - clean_data does the full conversion, so only sample here
             date_columns = ['cart_date', 'date']
             for col in date_columns:
-                try:
-                    pd.to_datetime(df[col], errors='coerce')
-                except:
+                if not column_converts(df[col], 'M', lambda values: pd.to_datetime(values, errors='coerce')):
                     return {'valid': False, 'message': f'Invalid date format in column: {col}'}
             
             # Check for ANC values
-            try:
-                pd.to_numeric(df['anc'], errors='coerce')
-            except:
+            if not column_converts(df['anc'], 'iuf', lambda values: pd.to_numeric(values, errors='coerce')):
                 return {'valid': False, 'message': 'Invalid ANC values - must be numeric'}
             
             return {'valid': True, 'message': 'File validation successful'}
@@ -50,118 +141,127 @@ class ExcelHandler:
         except Exception as e:
             return {'valid': False, 'message': f'File reading error: {str(e)}'}
     
-    def load_data(self, filepath):
+    def load_data(self, filepath, cached=False):
         """Load and clean data from Excel file"""
-        df = pd.read_excel(filepath)
-        
+        return self.clean_data(self.read_sheet(filepath, cached))
+    
+    def clean_data(self, df):
+        """Coerce dates and ANC values and drop rows missing essential data"""
         # Convert date columns
         date_columns = ['cart_date', 'date', 'last_fu_date', 'subsequent_therapy_date', 'progression_date']
-        for col in date_columns:
-            if col in df.columns:
-                df[col] = pd.to_datetime(df[col], errors='coerce')
+        # Columns that are already datetime64 (from the reader or parquet) are left alone
+        pending = [col for col in date_columns if col in df.columns and df[col].dtype.kind != 'M']
+        if pending:
+            df[pending] = df[pending].apply(pd.to_datetime, errors='coerce')
         
         # Convert ANC to numeric
         df['anc'] = pd.to_numeric(df['anc'], errors='coerce')
         
-        # Remove rows with missing essential data
+        # Remove rows with missing essential data; the filtered copy also merges the
+        # converted columns back into one contiguous block per dtype
         df = df.dropna(subset=['patient_id', 'cart_date'])
         
         return df
     
-    def export_results(self, results_df, output_buffer):
-        """Export results to Excel with formatting"""
-        with pd.ExcelWriter(output_buffer, engine='openpyxl') as writer:
-            # Main results sheet
-            results_df.to_excel(writer, sheet_name='ICAHT_Grades', index=False)
+    def export_results(self, columns, rows, output_buffer, chunk_size=5000):
+        """Stream result rows into a constant-memory xlsxwriter workbook with formatting
+
+        Returns the number of rows written. Column widths are sized from the
+        first chunk of rows because rows are flushed as soon as the next one
+        starts.
+        """
+        workbook = xlsxwriter.Workbook(output_buffer, {
+            'constant_memory': True,
+            # Patient IDs and grades are data: never turn them into formulas or links
+            'strings_to_formulas': False,
+            'strings_to_urls': False
+        })
+        ws_results = workbook.add_worksheet('ICAHT_Grades')
+        ws_summary = workbook.add_worksheet('Summary')
+        # Result rows stored before NaN nadirs were written as NULL still hold NaN
+        ws_results.add_write_handler(float, write_float)
+        grade_formats = {
+            grade: workbook.add_format({'bg_color': color}) for grade, color in GRADE_COLORS.items()
+        }
+        
+        rows = iter(rows)
+        first_chunk = list(islice(rows, chunk_size))
+        self._set_column_widths(ws_results, columns, first_chunk)
+        
+        # Main results sheet
+        ws_results.write_row(0, 0, columns, workbook.add_format(RESULTS_HEADER_FORMAT))
+        
+        early_idx = columns.index('early_icaht_grade') if 'early_icaht_grade' in columns else None
+        late_idx = columns.index('late_icaht_grade') if 'late_icaht_grade' in columns else None
+        special_idx = columns.index('grade_4_special') if 'grade_4_special' in columns else None
+        
+        early_counts = Counter()
+        late_counts = Counter()
+        grade_4_special = 0
+        total = 0
+        
+        for chunk in chain([first_chunk], iter(lambda: list(islice(rows, chunk_size)), [])):
+            for row in chunk:
+                total += 1
+                ws_results.write_row(total, 0, row)
             
-            # Summary sheet
-            summary_data = self._create_summary_sheet(results_df)
-            summary_data.to_excel(writer, sheet_name='Summary', index=False)
+            # Tally grades for the summary a chunk at a time; Counter.update counts in C
+            for idx, counts in ((early_idx, early_counts), (late_idx, late_counts)):
+                if idx is not None:
+                    counts.update(map(itemgetter(idx), chunk))
             
-            # Format worksheets
-            self._format_worksheets(writer, results_df)
+            if special_idx is not None:
+                grade_4_special += sum(map(bool, map(itemgetter(special_idx), chunk)))
+        
+        # Missing grades were counted too
+        early_counts.pop(None, None)
+        late_counts.pop(None, None)
+        
+        # Grade color coding: one conditional rule per grade and column, evaluated by Excel
+        for idx in (early_idx, late_idx):
+            if idx is None or not total:
+                continue
+            for grade, grade_format in grade_formats.items():
+                ws_results.conditional_format(1, idx, total, idx, {
+                    'type': 'cell', 'criteria': '==', 'value': f'"{grade}"', 'format': grade_format
+                })
+        
+        # Summary sheet
+        summary_columns = ['Category', 'Grade', 'Count', 'Percentage']
+        ws_summary.write_row(0, 0, summary_columns, workbook.add_format(SUMMARY_HEADER_FORMAT))
+        summary_rows = self._create_summary_rows(total, early_counts, late_counts, grade_4_special)
+        for row_num, summary_row in enumerate(summary_rows, start=1):
+            ws_summary.write_row(row_num, 0, summary_row)
+        
+        workbook.close()
+        return total
     
-    def _create_summary_sheet(self, results_df):
-        """Create summary statistics sheet"""
-        summary_data = []
+    def _create_summary_rows(self, total, early_counts, late_counts, grade_4_special):
+        """Create summary statistics rows"""
+        def percentage(count):
+            return f"{(count/total*100):.1f}%" if total else "0.0%"
+        
+        summary_rows = []
         
         # Early ICAHT summary
-        early_counts = results_df['early_icaht_grade'].value_counts().sort_index()
-        for grade, count in early_counts.items():
-            summary_data.append({
-                'Category': 'Early ICAHT',
-                'Grade': grade,
-                'Count': count,
-                'Percentage': f"{(count/len(results_df)*100):.1f}%"
-            })
+        for grade, count in sorted(early_counts.items()):
+            summary_rows.append(['Early ICAHT', grade, count, percentage(count)])
         
         # Late ICAHT summary
-        late_counts = results_df['late_icaht_grade'].value_counts().sort_index()
-        for grade, count in late_counts.items():
-            summary_data.append({
-                'Category': 'Late ICAHT',
-                'Grade': grade,
-                'Count': count,
-                'Percentage': f"{(count/len(results_df)*100):.1f}%"
-            })
+        for grade, count in sorted(late_counts.items()):
+            summary_rows.append(['Late ICAHT', grade, count, percentage(count)])
         
         # Special cases
-        grade_4_special = results_df['grade_4_special'].sum() if 'grade_4_special' in results_df.columns else 0
-        summary_data.append({
-            'Category': 'Special Cases',
-            'Grade': 'Grade 4 (Never recovered)',
-            'Count': grade_4_special,
-            'Percentage': f"{(grade_4_special/len(results_df)*100):.1f}%"
-        })
+        summary_rows.append(['Special Cases', 'Grade 4 (Never recovered)', grade_4_special, percentage(grade_4_special)])
         
-        return pd.DataFrame(summary_data)
+        return summary_rows
     
-    def _format_worksheets(self, writer, results_df):
-        """Apply formatting to Excel worksheets"""
-        from openpyxl.styles import Font, PatternFill, Alignment
-        
-        # Format main results sheet
-        ws_results = writer.sheets['ICAHT_Grades']
-        
-        # Header formatting
-        header_font = Font(bold=True, color="FFFFFF")
-        header_fill = PatternFill(start_color="366092", end_color="366092", fill_type="solid")
-        
-        for cell in ws_results[1]:
-            cell.font = header_font
-            cell.fill = header_fill
-            cell.alignment = Alignment(horizontal="center")
-        
-        # Auto-adjust column widths
-        for column in ws_results.columns:
-            max_length = 0
-            column_letter = column[0].column_letter
-            
-            for cell in column:
-                try:
-                    if len(str(cell.value)) > max_length:
-                        max_length = len(str(cell.value))
-                except:
-                    pass
-            
-            adjusted_width = min(max_length + 2, 50)
-            ws_results.column_dimensions[column_letter].width = adjusted_width
-        
-        # Grade color coding
-        grade_colors = {
-            'Grade 0': PatternFill(start_color="D4F4DD", end_color="D4F4DD", fill_type="solid"),
-            'Grade 1': PatternFill(start_color="FFF2CC", end_color="FFF2CC", fill_type="solid"),
-            'Grade 2': PatternFill(start_color="FFE699", end_color="FFE699", fill_type="solid"),
-            'Grade 3': PatternFill(start_color="FFCC99", end_color="FFCC99", fill_type="solid"),
-            'Grade 4': PatternFill(start_color="FFB3B3", end_color="FFB3B3", fill_type="solid")
-        }
-        
-        # Apply grade colors
-        for row in ws_results.iter_rows(min_row=2):
-            early_grade = row[1].value if len(row) > 1 else None
-            late_grade = row[2].value if len(row) > 2 else None
+    def _set_column_widths(self, ws, columns, sample_rows):
+        """Auto-adjust column widths from the header and a sample of rows"""
+        for idx, name in enumerate(columns):
+            max_length = len(str(name))
+            for row in sample_rows:
+                if row[idx] is not None:
+                    max_length = max(max_length, len(str(row[idx])))
             
-            if early_grade in grade_colors:
-                row[1].fill = grade_colors[early_grade]
-            if late_grade in grade_colors:
-                row[2].fill = grade_colors[late_grade]
+            ws.set_column(idx, idx, min(max_length + 2, 50))
@@ -1,292 +1,265 @@
 import pandas as pd
 import numpy as np
+import os
+import hashlib
+import tempfile
 from datetime import datetime, timedelta
 
+try:
+    from utils._numba_grading import early_exceedance_stats
+except ImportError:  # numba not installed - use the vectorized NumPy implementation
+    early_exceedance_stats = None
+
+# Grades as an ordered categorical: one small code per patient instead of a string
+GRADE_DTYPE = pd.CategoricalDtype(['Grade 0', 'Grade 1', 'Grade 2', 'Grade 3', 'Grade 4'], ordered=True)
+
+# Result columns per period, so an empty period still merges in combine_grades
+EARLY_RESULT_DTYPES = {
+    'patient_id': 'category',
+    'duration_below_500_max': np.int64,
+    'duration_below_100_max': np.int64,
+    'early_icaht_grade': GRADE_DTYPE,
+    'grade_4_special': bool,
+    'exceedances_500': np.int64,
+    'exceedances_100': np.int64
+}
+LATE_RESULT_DTYPES = {
+    'patient_id': 'category',
+    'anc_1': np.float64,
+    'anc_2': np.float64,
+    'late_icaht_grade': GRADE_DTYPE,
+    'anc_count': np.int64
+}
+
+def empty_results(dtypes):
+    """Zero-row results frame with the given columns and dtypes"""
+    return pd.DataFrame({col: pd.Series(dtype=dtype) for col, dtype in dtypes.items()})
+
+def joined_exceedances(codes, anc, days, threshold, recovery_days):
+    """Patient code, start day and end day of every joined period below threshold
+
+    Takes the non-missing rows only, grouped by patient code and sorted by day.
+    """
+    below = anc < threshold
+    same_patient = codes[1:] == codes[:-1]
+    
+    # Runs of consecutive below-threshold rows within a patient
+    first = below & ~np.r_[False, below[:-1] & same_patient]
+    last = below & ~np.r_[below[1:] & same_patient, False]
+    code, start, end = codes[first], days[first], days[last]
+    if not code.size:
+        return code, start, end
+    
+    # Recovery too short between two runs of the same patient - join them
+    separate = (code[1:] != code[:-1]) | (start[1:] - end[:-1] - 1 > recovery_days - 1)
+    heads = np.flatnonzero(np.r_[True, separate])
+    tails = np.flatnonzero(np.r_[separate, True])
+    return code[heads], start[heads], end[tails]
+
+def exceedance_totals(code, start, end, n_patients):
+    """Longest joined exceedance and number of exceedances per patient"""
+    duration = np.zeros(n_patients, np.int64)
+    np.maximum.at(duration, code, end - start + 1)
+    return duration, np.bincount(code, minlength=n_patients).astype(np.int64)
+
+def early_exceedance_stats_numpy(offsets, anc, days, threshold_500, threshold_100, recovery_days):
+    """Vectorized NumPy version of the numba early_exceedance_stats kernel, same inputs and results"""
+    n_patients = offsets.shape[0] - 1
+    codes = np.repeat(np.arange(n_patients), np.diff(offsets))
+    
+    # Missing values neither start nor end an exceedance
+    valid = ~np.isnan(anc)
+    codes, anc, days = codes[valid], anc[valid], days[valid]
+    
+    code, start, end = joined_exceedances(codes, anc, days, threshold_500, recovery_days)
+    duration_500, count_500 = exceedance_totals(code, start, end, n_patients)
+    duration_100, count_100 = exceedance_totals(
+        *joined_exceedances(codes, anc, days, threshold_100, recovery_days), n_patients
+    )
+    
+    # Only the final exceedance can reach the last day with ANC data
+    last_day = np.full(n_patients, -1, np.int64)
+    is_last = np.r_[codes[1:] != codes[:-1], True] if codes.size else np.zeros(0, bool)
+    last_day[codes[is_last]] = days[is_last]
+    is_final = np.r_[code[1:] != code[:-1], True] if code.size else np.zeros(0, bool)
+    grade_4_special = np.zeros(n_patients, np.bool_)
+    grade_4_special[code[is_final]] = (start[is_final] <= 3) & (end[is_final] == last_day[code[is_final]])
+    
+    return duration_500, duration_100, count_500, count_100, grade_4_special
+
 class ICahtGrader:
-    def __init__(self):
+    def __init__(self, cache_dir=None):
         self.anc_500_threshold = 501  # Use 501 to detect values ≤ 500
         self.anc_100_threshold = 101  # Use 101 to detect values ≤ 100
         self.recovery_days = 3  # Days required for neutrophil recovery
+        self.cache_dir = cache_dir  # Graded results are kept here as parquet when set
     
-    def grade_early_icaht(self, df_early):
-        """Grade early ICAHT (days 0-30)"""
-        results = []
-        
-        for patient_id in df_early['patient_id'].unique():
-            patient_data = df_early[df_early['patient_id'] == patient_id].copy()
-            patient_data = patient_data.sort_values('time_post_inf')
-            
-            # Calculate exceedances for ANC ≤ 500
-            exceedances_500 = self._calculate_exceedances(
-                patient_data, self.anc_500_threshold, below=True
-            )
-            
-            # Calculate exceedances for ANC ≤ 100
-            exceedances_100 = self._calculate_exceedances(
-                patient_data, self.anc_100_threshold, below=True
-            )
-            
-            # Get maximum durations
-            max_duration_500 = max([e['duration'] for e in exceedances_500], default=0)
-            max_duration_100 = max([e['duration'] for e in exceedances_100], default=0)
-            
-            # Check for grade 4 special cases
-            grade_4_special = self._check_grade_4_special_cases(
-                patient_data, exceedances_500
-            )
-            
-            # Assign grade
-            grade = self._assign_early_grade(
-                max_duration_500, max_duration_100, grade_4_special
-            )
-            
-            results.append({
-                'patient_id': patient_id,
-                'duration_below_500_max': max_duration_500,
-                'duration_below_100_max': max_duration_100,
-                'early_icaht_grade': grade,
-                'grade_4_special': grade_4_special,
-                'exceedances_500': len(exceedances_500),
-                'exceedances_100': len(exceedances_100)
-            })
-        
-        return pd.DataFrame(results)
+    def _cache_key(self, df):
+        """Digest of a frame's columns and values plus the grading parameters"""
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(repr((list(df.columns), self.anc_500_threshold,
+                            self.anc_100_threshold, self.recovery_days)).encode())
+        digest.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+        return digest.hexdigest()
     
-    def grade_late_icaht(self, df_late):
-        """Grade late ICAHT (days 31+)"""
-        results = []
+    def _cached_grades(self, kind, df, grade):
+        """Graded results for df, read from the parquet cache when the same input was graded before"""
+        if self.cache_dir is None:
+            return grade(df)
         
-        for patient_id in df_late['patient_id'].unique():
-            patient_data = df_late[df_late['patient_id'] == patient_id].copy()
-            
-            if len(patient_data) == 0:
-                # No data for late period
-                results.append({
-                    'patient_id': patient_id,
-                    'anc_1': np.nan,
-                    'anc_2': np.nan,
-                    'late_icaht_grade': 'Grade 0'
-                })
-                continue
-            
-            # Get 2 lowest ANC values
-            anc_values = patient_data['anc'].dropna().sort_values()
-            
-            anc_1 = anc_values.iloc[0] if len(anc_values) > 0 else np.nan
-            anc_2 = anc_values.iloc[1] if len(anc_values) > 1 else np.nan
-            
-            # Assign grade
-            grade = self._assign_late_grade(anc_1, anc_2)
-            
-            results.append({
-                'patient_id': patient_id,
-                'anc_1': anc_1,
-                'anc_2': anc_2,
-                'late_icaht_grade': grade,
-                'anc_count': len(anc_values)
-            })
+        path = os.path.join(self.cache_dir, f"{kind}_{self._cache_key(df)}.parquet")
+        if os.path.exists(path):
+            return pd.read_parquet(path)
         
-        return pd.DataFrame(results)
+        results = grade(df)
+        # Write then rename, so another worker never reads a half-written file
+        os.makedirs(self.cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            results.to_parquet(f)
+        os.replace(tmp_path, path)
+        return results
     
-    def _calculate_exceedances(self, patient_data, threshold, below=True):
-        """Calculate exceedances (periods below/above threshold)"""
-        if below:
-            condition = patient_data['anc_final'] < threshold
-        else:
-            condition = patient_data['anc_final'] >= threshold
-        
-        # Remove NaN values
-        valid_data = patient_data.dropna(subset=['anc_final'])
-        if len(valid_data) == 0:
-            return []
-        
-        condition = condition.reindex(valid_data.index, fill_value=False)
-        
-        exceedances = []
-        in_exceedance = False
-        current_exceedance = None
+    def grade_early_icaht(self, df_early):
+        """Grade early ICAHT (days 0-30)"""
+        if len(df_early) == 0:
+            return empty_results(EARLY_RESULT_DTYPES)
+        return self._cached_grades('early', df_early, self._grade_early)
+    
+    def _grade_early(self, df_early):
+        """Early ICAHT grades for a non-empty early window"""
+        # Group on categorical codes (prepare_data already provides them)
+        if not isinstance(df_early['patient_id'].dtype, pd.CategoricalDtype):
+            df_early = df_early.assign(patient_id=df_early['patient_id'].astype('category'))
         
-        for idx, row in valid_data.iterrows():
-            if condition.loc[idx] and not in_exceedance:
-                # Start new exceedance
-                in_exceedance = True
-                current_exceedance = {
-                    'start_day': row['time_post_inf'],
-                    'start_date': row['date'],
-                    'end_day': row['time_post_inf'],
-                    'end_date': row['date'],
-                    'duration': 1
-                }
-            elif condition.loc[idx] and in_exceedance:
-                # Continue exceedance
-                current_exceedance['end_day'] = row['time_post_inf']
-                current_exceedance['end_date'] = row['date']
-                current_exceedance['duration'] = (
-                    current_exceedance['end_day'] - current_exceedance['start_day'] + 1
-                )
-            elif not condition.loc[idx] and in_exceedance:
-                # End exceedance
-                in_exceedance = False
-                exceedances.append(current_exceedance)
-                current_exceedance = None
+        # Group rows by patient (in order of first appearance), then by day
+        codes, patient_ids = pd.factorize(df_early['patient_id'])
+        days = df_early['time_post_inf'].to_numpy(dtype=np.int32)
+        order = np.lexsort((days, codes))
+        offsets = np.searchsorted(codes[order], np.arange(len(patient_ids) + 1))
+        anc = df_early['anc_final'].to_numpy(dtype=np.float32, na_value=np.nan)[order]
         
-        # Handle exceedance that continues to end of data
-        if in_exceedance and current_exceedance:
-            exceedances.append(current_exceedance)
+        stats = early_exceedance_stats if early_exceedance_stats is not None else early_exceedance_stats_numpy
+        duration_500, duration_100, count_500, count_100, grade_4_special = stats(
+            offsets, anc, days[order],
+            self.anc_500_threshold, self.anc_100_threshold, self.recovery_days
+        )
         
-        # Join adjacent exceedances if recovery period is too short
-        exceedances = self._join_adjacent_exceedances(exceedances, valid_data)
+        grades = self._assign_early_grades(duration_500, duration_100, grade_4_special)
         
-        return exceedances
+        return pd.DataFrame({
+            'patient_id': patient_ids,
+            'duration_below_500_max': duration_500,
+            'duration_below_100_max': duration_100,
+            'early_icaht_grade': grades,
+            'grade_4_special': grade_4_special,
+            'exceedances_500': count_500,
+            'exceedances_100': count_100
+        })
     
-    def _join_adjacent_exceedances(self, exceedances, patient_data):
-        """Join adjacent exceedances if recovery period is insufficient"""
-        if len(exceedances) <= 1:
-            return exceedances
-        
-        joined_exceedances = []
-        current_exceedance = exceedances[0].copy()
-        
-        for i in range(1, len(exceedances)):
-            next_exceedance = exceedances[i]
-            
-            # Check gap between exceedances
-            gap_days = next_exceedance['start_day'] - current_exceedance['end_day'] - 1
-            
-            if gap_days <= self.recovery_days - 1:  # -1 because we need 3 consecutive days
-                # Join exceedances
-                current_exceedance['end_day'] = next_exceedance['end_day']
-                current_exceedance['end_date'] = next_exceedance['end_date']
-                current_exceedance['duration'] = (
-                    current_exceedance['end_day'] - current_exceedance['start_day'] + 1
-                )
-            else:
-                # Keep separate
-                joined_exceedances.append(current_exceedance)
-                current_exceedance = next_exceedance.copy()
-        
-        joined_exceedances.append(current_exceedance)
-        return joined_exceedances
+    def grade_late_icaht(self, df_late):
+        """Grade late ICAHT (days 31+)"""
+        if len(df_late) == 0:
+            return empty_results(LATE_RESULT_DTYPES)
+        return self._cached_grades('late', df_late, self._grade_late)
     
-    def _check_grade_4_special_cases(self, patient_data, exceedances_500):
-        """Check for special grade 4 cases"""
-        if not exceedances_500:
-            return False
+    def _grade_late(self, df_late):
+        """Late ICAHT grades for a non-empty late window"""
+        # Group on categorical codes (prepare_data already provides them)
+        if not isinstance(df_late['patient_id'].dtype, pd.CategoricalDtype):
+            df_late = df_late.assign(patient_id=df_late['patient_id'].astype('category'))
         
-        # Get last day with ANC data
-        last_day_data = patient_data.dropna(subset=['anc_final']).iloc[-1]
-        last_day = last_day_data['time_post_inf']
+        # Get 2 lowest ANC values: sort once, then rank readings within each patient
+        valid = df_late[['patient_id', 'anc']].dropna(subset=['anc']).sort_values(['patient_id', 'anc'])
+        rank = valid.groupby('patient_id', observed=True).cumcount().to_numpy()
+        lowest = valid['anc'].set_axis(valid['patient_id'])
         
-        for exceedance in exceedances_500:
-            # Check if exceedance starts in days 0-3 and continues to end of follow-up
-            if (exceedance['start_day'] <= 3 and 
-                exceedance['end_day'] == last_day):
-                return True
+        patients = df_late['patient_id'].unique()
+        results = pd.DataFrame({
+            'patient_id': patients,
+            'anc_1': lowest[rank == 0].reindex(patients).to_numpy(),
+            'anc_2': lowest[rank == 1].reindex(patients).to_numpy(),
+            'anc_count': valid.groupby('patient_id', observed=True).size().reindex(patients, fill_value=0).to_numpy()
+        })
         
-        return False
-    
-    def _assign_early_grade(self, duration_500, duration_100, grade_4_special):
-        """Assign early ICAHT grade based on durations"""
-        if grade_4_special:
-            return "Grade 4"
+        # Assign all grades at once
+        results.insert(3, 'late_icaht_grade', self._assign_late_grades(
+            results['anc_1'].to_numpy(dtype=np.float32), results['anc_2'].to_numpy(dtype=np.float32)
+        ))
         
-        if duration_500 == 0 and duration_100 == 0:
-            return "Grade 0"
-        elif duration_500 in range(1, 7) and duration_100 < 7:
-            return "Grade 1"
-        elif duration_500 in range(7, 14) and duration_100 < 7:
-            return "Grade 2"
-        elif ((duration_500 in range(14, 31) and duration_100 < 7) or
-              (duration_500 < 31 and duration_100 in range(7, 14))):
-            return "Grade 3"
-        elif duration_500 >= 31 or duration_100 >= 14:
-            return "Grade 4"
-        else:
-            return "Grade 0"
+        return results
     
-    def _assign_late_grade(self, anc_1, anc_2):
-        """Assign late ICAHT grade based on nadir ANC values"""
-        if pd.isna(anc_1):
-            return "Grade 0"
-        
-        # Check conditions based on lowest ANC
-        if ((anc_1 in range(1001, 1501) and (pd.isna(anc_2) or anc_2 <= 1500)) or
-            (anc_1 in range(1001, 1501) and pd.isna(anc_2))):
-            return "Grade 1"
-        elif ((anc_1 in range(501, 1001) and (pd.isna(anc_2) or anc_2 <= 1500)) or
-              (anc_1 in range(501, 1001) and pd.isna(anc_2))):
-            return "Grade 2"
-        elif ((anc_1 in range(101, 501) and (pd.isna(anc_2) or anc_2 <= 1500)) or
-              (anc_1 in range(101, 501) and pd.isna(anc_2))):
-            return "Grade 3"
-        elif anc_1 <= 100:
-            return "Grade 4"
-        else:
-            return "Grade 0"
+    def _assign_early_grades(self, duration_500, duration_100, grade_4_special):
+        """Assign early ICAHT grades from per-patient duration arrays"""
+        d500, d100 = duration_500, duration_100
+        grades = np.select(
+            [
+                grade_4_special,
+                (d500 == 0) & (d100 == 0),
+                (d500 >= 1) & (d500 < 7) & (d100 < 7),
+                (d500 >= 7) & (d500 < 14) & (d100 < 7),
+                ((d500 >= 14) & (d500 < 31) & (d100 < 7)) | ((d500 < 31) & (d100 >= 7) & (d100 < 14)),
+                (d500 >= 31) | (d100 >= 14)
+            ],
+            ["Grade 4", "Grade 0", "Grade 1", "Grade 2", "Grade 3", "Grade 4"],
+            default="Grade 0"
+        )
+        return pd.Categorical(grades, dtype=GRADE_DTYPE)
+    
+    def _assign_late_grades(self, anc_1, anc_2):
+        """Assign late ICAHT grades from per-patient nadir ANC arrays"""
+        # Bands only match whole ANC values, as the range() membership tests they replace did
+        whole = anc_1 == np.floor(anc_1)
+        second_ok = np.isnan(anc_2) | (anc_2 <= 1500)
+        grades = np.select(
+            [
+                np.isnan(anc_1),
+                whole & (anc_1 >= 1001) & (anc_1 < 1501) & second_ok,
+                whole & (anc_1 >= 501) & (anc_1 < 1001) & second_ok,
+                whole & (anc_1 >= 101) & (anc_1 < 501) & second_ok,
+                anc_1 <= 100
+            ],
+            ["Grade 0", "Grade 1", "Grade 2", "Grade 3", "Grade 4"],
+            default="Grade 0"
+        )
+        return pd.Categorical(grades, dtype=GRADE_DTYPE)
     
     def combine_grades(self, early_grades, late_grades):
         """Combine early and late ICAHT grades"""
-        # Get all patient IDs
-        all_patients = set(early_grades['patient_id'].tolist() + 
-                          late_grades['patient_id'].tolist())
+        combined = early_grades.merge(late_grades, on='patient_id', how='outer')
         
-        combined = []
-        for patient_id in all_patients:
-            early_data = early_grades[early_grades['patient_id'] == patient_id]
-            late_data = late_grades[late_grades['patient_id'] == patient_id]
-            
-            result = {'patient_id': patient_id}
-            
-            # Add early grade data
-            if len(early_data) > 0:
-                early_row = early_data.iloc[0]
-                result.update({
-                    'early_icaht_grade': early_row['early_icaht_grade'],
-                    'duration_below_500_max': early_row['duration_below_500_max'],
-                    'duration_below_100_max': early_row['duration_below_100_max'],
-                    'grade_4_special': early_row['grade_4_special']
-                })
-            else:
-                result.update({
-                    'early_icaht_grade': 'Grade 0',
-                    'duration_below_500_max': 0,
-                    'duration_below_100_max': 0,
-                    'grade_4_special': False
-                })
-            
-            # Add late grade data
-            if len(late_data) > 0:
-                late_row = late_data.iloc[0]
-                result.update({
-                    'late_icaht_grade': late_row['late_icaht_grade'],
-                    'anc_1': late_row['anc_1'],
-                    'anc_2': late_row['anc_2'],
-                    'anc_count': late_row['anc_count']
-                })
-            else:
-                result.update({
-                    'late_icaht_grade': 'Grade 0',
-                    'anc_1': np.nan,
-                    'anc_2': np.nan,
-                    'anc_count': 0
-                })
-            
-            combined.append(result)
+        # Patients missing from either period get that period's defaults; anc_1/anc_2 stay NaN
+        combined = combined.fillna({
+            'early_icaht_grade': 'Grade 0',
+            'duration_below_500_max': 0,
+            'duration_below_100_max': 0,
+            'grade_4_special': False,
+            'late_icaht_grade': 'Grade 0',
+            'anc_count': 0
+        }).astype({
+            'duration_below_500_max': np.int64,
+            'duration_below_100_max': np.int64,
+            'grade_4_special': bool,
+            'anc_count': np.int64
+        })
         
-        return pd.DataFrame(combined)
+        return combined[[
+            'patient_id', 'early_icaht_grade', 'duration_below_500_max', 'duration_below_100_max',
+            'grade_4_special', 'late_icaht_grade', 'anc_1', 'anc_2', 'anc_count'
+        ]]
     
     def generate_summary(self, final_grades, processed_data):
         """Generate summary statistics"""
         total_patients = len(final_grades)
         
         # Early ICAHT distribution
-        early_dist = final_grades['early_icaht_grade'].value_counts().to_dict()
+        early_dist = self._grade_distribution(final_grades['early_icaht_grade'])
         
         # Late ICAHT distribution
-        late_dist = final_grades['late_icaht_grade'].value_counts().to_dict()
+        late_dist = self._grade_distribution(final_grades['late_icaht_grade'])
         
         # Special cases
-        grade_4_special_count = final_grades['grade_4_special'].sum()
+        grade_4_special_count = final_grades['grade_4_special'].to_numpy().sum()
         
         # Data quality metrics
         early_data_quality = self._assess_data_quality(processed_data['early'])
@@ -303,17 +276,24 @@ class ICahtGrader:
             }
         }
     
+    def _grade_distribution(self, grades):
+        """Patients per grade, counted from the categorical codes"""
+        codes = grades.astype(GRADE_DTYPE).cat.codes.to_numpy()
+        counts = np.bincount(codes[codes >= 0], minlength=len(GRADE_DTYPE.categories))
+        return dict(zip(GRADE_DTYPE.categories, counts.tolist()))
+    
     def _assess_data_quality(self, df):
         """Assess data quality metrics"""
         if len(df) == 0:
             return {'patients_with_data': 0, 'interpolation_rate': 0}
         
-        total_patients = df['patient_id'].nunique()
+        # factorize drops missing IDs, matching nunique
+        total_patients = pd.factorize(df['patient_id'])[1].size
         
-        # Calculate interpolation rate
-        total_values = len(df)
-        interpolated_values = df['anc_final'].isna().sum()
-        interpolation_rate = interpolated_values / total_values if total_values > 0 else 0
+        # Calculate interpolation rate; the late period isn't interpolated, so its raw ANC stands in
+        column = 'anc_final' if 'anc_final' in df.columns else 'anc'
+        anc_final = df[column].to_numpy(dtype=np.float64, na_value=np.nan)
+        interpolation_rate = np.isnan(anc_final).sum() / anc_final.size
         
         return {
             'patients_with_data': total_patients,